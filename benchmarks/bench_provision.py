@@ -0,0 +1,281 @@
+#!/usr/bin/python
+"""
+End-to-end benchmark of docker-dialog provisioning
+
+Serves this repository tree from a local HTTP server with configurable latency
+and bandwidth, puts stub docker and docker-compose binaries first in $PATH and
+installs every template from docker.yml with docker_dialog.py --manifest.
+Cold run starts with an empty cache, warm runs reuse it.
+
+Usage:
+    python benchmarks/bench_provision.py [--latency 0.05] [--bandwidth 1024] [--runs 3]
+                                         [--save result.json] [--baseline result.json]
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from subprocess import Popen
+from StringIO import StringIO
+from email.utils import parsedate_tz, mktime_tz
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_DOCKER = """#!/bin/sh
+# docker stub: every image is missing locally and pulled instantly
+case "$1" in
+    inspect) exit 1;;
+esac
+exit 0
+"""
+
+STUB_COMPOSE = """#!/bin/sh
+# docker-compose stub: reports every service of the project as started
+echo "Creating network \\"bench_default\\" with the default driver" >&2
+exit 0
+"""
+
+
+class ThrottledServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server with counters of served requests and bytes
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency, bandwidth):
+        HTTPServer.__init__(self, address, ThrottledHandler)
+        # seconds before every response
+        self.latency = latency
+        # bytes per second, 0 means unlimited
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.not_modified = 0
+            self.bytes_sent = 0
+
+
+class ThrottledHandler(SimpleHTTPRequestHandler):
+    """
+    Serves REPO_ROOT over keep-alive HTTP/1.1 with ETag/Last-Modified revalidation,
+    gzip content encoding of text files, latency and bandwidth limit
+    """
+    protocol_version = "HTTP/1.1"
+    compressed_extensions = (".tgz", ".gz", ".bz2", ".xz", ".pack")
+
+    def log_message(self, format, *args):
+        pass
+
+    def translate_path(self, path):
+        path = SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(REPO_ROOT, os.path.relpath(path, os.getcwd()))
+
+    def send_head(self):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            etag = '"{0}-{1}"'.format(int(stat.st_mtime), stat.st_size)
+            since = self.headers.get('If-Modified-Since')
+            if self.headers.get('If-None-Match') == etag or (
+                    since and parsedate_tz(since) and
+                    mktime_tz(parsedate_tz(since)) >= int(stat.st_mtime)):
+                with self.server.lock:
+                    self.server.not_modified += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return None
+            self._etag = etag
+            if ("gzip" in self.headers.get('Accept-Encoding', "") and
+                    not path.endswith(self.compressed_extensions)):
+                return self.send_gzip(path, stat)
+        return SimpleHTTPRequestHandler.send_head(self)
+
+    def send_gzip(self, path, stat):
+        body = StringIO()
+        with open(path, 'rb') as source:
+            with gzip.GzipFile(fileobj=body, mode='wb') as compressed:
+                compressed.write(source.read())
+        self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body.getvalue())))
+        self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+        self.end_headers()
+        body.seek(0)
+        return body
+
+    def end_headers(self):
+        if getattr(self, '_etag', None):
+            self.send_header("ETag", self._etag)
+            self._etag = None
+        SimpleHTTPRequestHandler.end_headers(self)
+
+    def copyfile(self, source, outputfile):
+        chunk_size = 16 * 1024
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            with self.server.lock:
+                self.server.bytes_sent += len(chunk)
+            if self.server.bandwidth:
+                time.sleep(float(len(chunk)) / self.server.bandwidth)
+
+
+def write_stubs(directory):
+    for name, content in (("docker", STUB_DOCKER), ("docker-compose", STUB_COMPOSE)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as stub:
+            stub.write(content)
+        os.chmod(path, 0755)
+
+
+def build_manifest(target_directory):
+    """
+    Returns manifest with every template of docker.yml and generated vars
+    """
+    with open(os.path.join(REPO_ROOT, "docker.yml")) as catalog_file:
+        catalog = yaml.safe_load(catalog_file)
+    stacks = []
+    port = 20000
+    for category, section in sorted(catalog.items()):
+        for template, options in sorted(section['options'].items()):
+            variables = {}
+            for variable in options.get('vars', []):
+                if variable.upper().endswith("_PORT"):
+                    port += 1
+                    variables[variable] = port
+                else:
+                    variables[variable] = "bench"
+            stacks.append({
+                'category': category,
+                'template': template,
+                'vars': variables,
+                'directory': os.path.join(target_directory, template),
+            })
+    return stacks
+
+
+def run_once(server, base_url, work_directory, cache_directory, bin_directory, workers):
+    """
+    Installs all templates once. Returns dict with timings and counters
+    """
+    target_directory = tempfile.mkdtemp(prefix="targets-", dir=work_directory)
+    manifest_path = os.path.join(target_directory, "manifest.json")
+    report_path = os.path.join(target_directory, "report.json")
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(build_manifest(target_directory), manifest_file)
+    env = dict(
+        os.environ,
+        PATH=bin_directory + os.pathsep + os.environ.get("PATH", ""),
+        DOCKER_DIALOG_CACHE_DIR=cache_directory,
+        DOCKER_DIALOG_READY_TIMEOUT="0")
+    server.reset()
+    started = time.time()
+    process = Popen(
+        [sys.executable, os.path.join(REPO_ROOT, "docker_dialog.py"),
+         "--base-url", base_url, "--manifest", manifest_path,
+         "--workers", str(workers), "--report", report_path],
+        env=env)
+    # wait4 returns resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - started
+    with open(report_path) as report_file:
+        report = json.load(report_file)
+    shutil.rmtree(target_directory, ignore_errors=True)
+    return {
+        'seconds': round(elapsed, 3),
+        'exit_status': status >> 8,
+        'stacks': len(report),
+        'failed': sorted(stack['template'] for stack in report if stack['status'] != "ok"),
+        'requests': server.requests,
+        'not_modified': server.not_modified,
+        'bytes_fetched': server.bytes_sent,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': usage.ru_maxrss,
+    }
+
+
+def print_summary(results, baseline=None):
+    for name in ("cold", "warm"):
+        runs = results[name]
+        if not runs:
+            continue
+        best = min(run['seconds'] for run in runs)
+        line = "{0:5} best {1:7.3f}s  bytes {2:8}  requests {3:4}  304s {4:4}  peak rss {5:6} KB".format(
+            name, best, runs[0]['bytes_fetched'], runs[0]['requests'],
+            runs[0]['not_modified'], max(run['peak_rss_kb'] for run in runs))
+        if baseline and baseline.get(name):
+            base = min(run['seconds'] for run in baseline[name])
+            line += "  ({0:+.1f}% vs baseline)".format(100.0 * (best - base) / base)
+        print line
+        failed = sorted(set(template for run in runs for template in run['failed']))
+        if failed:
+            print "      failed templates: {0}".format(", ".join(failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of docker-dialog provisioning")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds of latency added to every request")
+    parser.add_argument("--bandwidth", type=int, default=0,
+                        help="server bandwidth in KB/s, 0 means unlimited")
+    parser.add_argument("--runs", type=int, default=3, help="number of warm runs")
+    parser.add_argument("--workers", type=int, default=4, help="stacks installed at once")
+    parser.add_argument("--save", help="write results to the JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    args = parser.parse_args()
+
+    work_directory = tempfile.mkdtemp(prefix="docker-dialog-bench-")
+    bin_directory = os.path.join(work_directory, "bin")
+    cache_directory = os.path.join(work_directory, "cache")
+    os.makedirs(bin_directory)
+    write_stubs(bin_directory)
+    server = ThrottledServer(("127.0.0.1", 0), args.latency, args.bandwidth * 1024)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+    try:
+        results = {'cold': [], 'warm': [], 'latency': args.latency, 'bandwidth': args.bandwidth}
+        results['cold'].append(run_once(
+            server, base_url, work_directory, cache_directory, bin_directory, args.workers))
+        for _ in range(args.runs):
+            results['warm'].append(run_once(
+                server, base_url, work_directory, cache_directory, bin_directory, args.workers))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_summary(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""
+Cold-start benchmark of the interactive docker-dialog entry point
+
+Measures time from the start of docker_dialog.py to its first menu (category
+selection). A stub dialog binary answers "yes" to the first question, notes the
+time when the menu is shown and cancels it, so the script exits right away.
+The repository tree is served by the local HTTP server of bench_provision.
+First run starts with an empty cache, warm runs reuse it.
+Exits with status 1 if the median warm run is slower than --budget.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--budget 150] [--latency 0]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from subprocess import Popen
+
+from bench_provision import REPO_ROOT, ThrottledServer, write_stubs
+
+# pythondialog passes arguments with --file to dialog 1.2-20150513 and newer,
+# so older version is reported to get them on the command line
+STUB_DIALOG = """#!/bin/sh
+# dialog stub: notes the time of the first menu and cancels it
+case "$*" in
+    *--print-version*) echo "Version: 1.2-20140112" >&2;;
+    *--menu*) date +%s.%N >> "$DIALOG_STUB_LOG"; exit 1;;
+esac
+exit 0
+"""
+
+
+def write_dialog_stub(directory):
+    path = os.path.join(directory, "dialog")
+    with open(path, 'w') as stub:
+        stub.write(STUB_DIALOG)
+    os.chmod(path, 0755)
+
+
+def run_once(base_url, work_directory, cache_directory, bin_directory):
+    """
+    Starts the script once. Returns seconds to the first menu
+    """
+    log_path = os.path.join(work_directory, "menu.log")
+    if os.path.exists(log_path):
+        os.unlink(log_path)
+    env = dict(
+        os.environ,
+        PATH=bin_directory + os.pathsep + os.environ.get("PATH", ""),
+        DOCKER_DIALOG_CACHE_DIR=cache_directory,
+        DIALOG_STUB_LOG=log_path,
+        TERM=os.environ.get("TERM", "dumb"))
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        process = Popen(
+            [sys.executable, os.path.join(REPO_ROOT, "docker_dialog.py"), "--base-url", base_url],
+            env=env, stdout=devnull)
+        process.wait()
+    if not os.path.exists(log_path):
+        raise SystemExit("docker_dialog.py exited with code {0} before the first menu".format(
+            process.returncode))
+    with open(log_path) as log_file:
+        return float(log_file.readline()) - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark of docker-dialog")
+    parser.add_argument("--runs", type=int, default=5, help="number of warm runs")
+    parser.add_argument("--budget", type=float, default=150,
+                        help="milliseconds to the first menu, which median warm run may take")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds of latency added to every request")
+    args = parser.parse_args()
+
+    work_directory = tempfile.mkdtemp(prefix="docker-dialog-startup-")
+    bin_directory = os.path.join(work_directory, "bin")
+    cache_directory = os.path.join(work_directory, "cache")
+    os.makedirs(bin_directory)
+    write_stubs(bin_directory)
+    write_dialog_stub(bin_directory)
+    server = ThrottledServer(("127.0.0.1", 0), args.latency, 0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+    try:
+        cold = run_once(base_url, work_directory, cache_directory, bin_directory)
+        warm = sorted(
+            run_once(base_url, work_directory, cache_directory, bin_directory)
+            for _ in range(max(1, args.runs)))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    median = warm[len(warm) // 2] * 1000
+    print "cold   {0:7.1f} ms".format(cold * 1000)
+    print "warm   best {0:7.1f} ms  median {1:7.1f} ms  budget {2:.0f} ms".format(
+        warm[0] * 1000, median, args.budget)
+    if median > args.budget:
+        print "time to the first menu is over the budget"
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""
+Regression check of the interactive docker-compose progress
+
+Installs lamp template from the local HTTP server of bench_provision with stub
+docker and docker-compose, then runs DockerDialog.run_composer with a stub
+dialog binary, which reads progressbox input to EOF like the real one.
+If any child process keeps the write end of the progress pipe, EOF never comes
+and run_composer hangs. Exits with status 1 if it doesn't return in --timeout.
+
+Usage:
+    python benchmarks/check_progressbox.py [--timeout 10]
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import threading
+
+from bench_provision import REPO_ROOT, ThrottledServer, write_stubs
+
+sys.path.insert(0, REPO_ROOT)
+import docker_dialog
+
+# pythondialog passes arguments with --file to dialog 1.2-20150513 and newer,
+# so older version is reported to get them on the command line
+STUB_DIALOG = """#!/bin/sh
+# dialog stub: progressbox reads its input until the pipe is closed
+case "$*" in
+    *--print-version*) echo "Version: 1.2-20140112" >&2;;
+    *--progressbox*) cat > /dev/null;;
+esac
+exit 0
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regression check of docker-compose progressbox")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds, which run_composer may take")
+    args = parser.parse_args()
+
+    work_directory = tempfile.mkdtemp(prefix="docker-dialog-progressbox-")
+    bin_directory = os.path.join(work_directory, "bin")
+    os.makedirs(bin_directory)
+    write_stubs(bin_directory)
+    with open(os.path.join(bin_directory, "dialog"), 'w') as stub:
+        stub.write(STUB_DIALOG)
+    os.chmod(os.path.join(bin_directory, "dialog"), 0755)
+    os.environ["PATH"] = bin_directory + os.pathsep + os.environ.get("PATH", "")
+    server = ThrottledServer(("127.0.0.1", 0), 0, 0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+    result = []
+    ydialog = None
+    try:
+        ydialog = docker_dialog.DockerDialog(base_url, headless=True)
+        stack = ydialog.for_stack(
+            "Stack", "lamp", {'MYSQL_ROOT_PASSWORD': "check"}, os.path.join(work_directory, "lamp"))
+        os.makedirs(stack.template_directory)
+        failures = stack.fetch_all(
+            stack.template_config().get('urls', []), docker_dialog.bundle_entry(stack.template_config()))
+        if failures:
+            raise SystemExit("Loading failed: {0}".format(failures))
+        from dialog import Dialog
+        stack.dialog = Dialog()
+        composer = threading.Thread(target=lambda: result.append(stack.run_composer()))
+        composer.daemon = True
+        composer.start()
+        composer.join(args.timeout)
+    finally:
+        if ydialog is not None:
+            # keep-alive connections are closed, so server threads finish before exit
+            ydialog.session.close()
+        server.shutdown()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    if not result:
+        print "run_composer didn't return in {0} seconds".format(args.timeout)
+        # composer thread is stuck in dialog, so interpreter can't exit normally
+        os._exit(1)
+    print "run_composer returned {0}".format(result[0])
+    raise SystemExit(0 if result[0] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
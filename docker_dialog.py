@@ -3,14 +3,1977 @@
 import time
 import re
 import os
-import tarfile
-from urllib2 import urlopen
-from urllib import urlretrieve
-from urlparse import urljoin
+import json
+import mmap
+import struct
+import errno
+import fcntl
+import select
+import socket
+import argparse
+import signal
+import itertools
+import bisect
+import hashlib
+import copy
+import atexit
+import tempfile
+import fnmatch
+import threading
+from Queue import Queue, Empty
+import zlib
+import random
+from urlparse import urljoin, urlsplit
 from subprocess import Popen, PIPE
-import yaml
-from jinja2 import Environment
-from dialog import Dialog
+from shutil import copyfileobj, copy2, rmtree
+# yaml, jinja2, tarfile, httplib and dialog are imported by the functions, which use them,
+# so they don't delay the first menu or aren't loaded at all in the modes without them
+
+
+class ProvisionError(Exception):
+    """
+    Raised, when template can't be installed without user interaction
+    """
+    pass
+
+
+class Span(object):
+    """
+    Timed section of the provisioning, recorded by Tracer when it's finished
+    """
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = str(exc_value) or exc_type.__name__
+        self.tracer.add(self.name, self.start, time.time(), self.args)
+        return False
+
+
+class NullSpan(object):
+    """
+    Span of the disabled tracer, which does nothing
+    """
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """
+    Records spans of the provisioning stages and writes them in Chrome trace format,
+    which may be opened with chrome://tracing or Perfetto.
+    Disabled tracer returns the shared NULL_SPAN, so it costs only a method call
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def add(self, name, start, end, args):
+        event = {
+            'name': name,
+            'ph': "X",
+            'ts': int((start - self.started) * 1000000),
+            'dur': int((end - start) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, trace_file)
+
+
+class CountingStream(object):
+    """
+    File-like wrapper, which counts bytes read from the stream
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes += len(data)
+        return data
+
+
+def find_binaries(names):
+    """
+    Returns dict with the path of every binary from names, which is found within $PATH.
+    PATH is scanned once for all names and the scan stops, when all of them are found
+    """
+    found = {}
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        directory = directory.strip('"')
+        for name in names:
+            if name in found:
+                continue
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                found[name] = path
+        if len(found) == len(set(names)):
+            break
+    return found
+
+
+def check_stack_entry(entry):
+    """
+    Raises ProvisionError if the manifest or daemon entry of the stack has wrong types
+    """
+    if not isinstance(entry, dict):
+        raise ProvisionError("Stack should be a mapping, not {0!r}".format(entry))
+    for key in ('category', 'template'):
+        if not isinstance(entry.get(key), basestring):
+            raise ProvisionError("{0} of the stack should be a string".format(key))
+    if entry.get('vars') is not None and not isinstance(entry['vars'], dict):
+        raise ProvisionError("vars of the stack should be a mapping")
+    if entry.get('directory') is not None and not isinstance(entry['directory'], basestring):
+        raise ProvisionError("directory of the stack should be a string")
+
+
+def failed_result(entry, error):
+    """
+    Returns result of the stack, which failed before its installation started
+    """
+    entry = entry if isinstance(entry, dict) else {}
+    return {
+        'category': entry.get('category'),
+        'template': entry.get('template'),
+        'directory': entry.get('directory'),
+        'status': "failed",
+        'error': str(error) or error.__class__.__name__,
+    }
+
+
+def run_in_threads(function, items, workers):
+    """
+    Calls function for every item with at most workers threads at once.
+    Returns list of (item, result, exception) tuples in the order of items
+    """
+    tasks = Queue()
+    for position, item in enumerate(items):
+        tasks.put((position, item))
+    results = [None] * len(items)
+
+    def worker():
+        while True:
+            try:
+                position, item = tasks.get_nowait()
+            except Empty:
+                return
+            try:
+                results[position] = (item, function(item), None)
+            except Exception as error:
+                results[position] = (item, None, error)
+
+    threads = []
+    for _ in range(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # join with timeout keeps main thread responsive for KeyboardInterrupt
+        while thread.is_alive():
+            thread.join(0.1)
+    return results
+
+
+def memory_available():
+    """
+    Returns MemAvailable from /proc/meminfo in megabytes or None if it's unknown
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def cpu_count():
+    try:
+        return os.sysconf("SC_NPROCESSORS_ONLN")
+    except (ValueError, OSError):
+        return 1
+
+
+class ResourceScheduler(object):
+    """
+    Admits docker-compose runs of concurrent stacks by their weight,
+    so heavy templates don't starve the others.
+    Weight is dict with cpu (cores) and memory (megabytes) keys, like
+    weight of the template in docker.yml. Runs are admitted in FIFO order,
+    while sum of weights of the admitted runs fits into cores and memory.
+    Memory is MemAvailable, read on every admission, so containers of the
+    finished runs, which are still running, are taken into account.
+    Run, which is heavier than the whole host, is admitted alone
+    """
+    default_weight = {'cpu': 1, 'memory': 256}
+    # MemAvailable may grow without any release, so waiting runs check it again
+    poll_interval = 1
+    # megabytes, if MemAvailable can't be read
+    fallback_memory = 1024
+
+    def __init__(self, cores=None, memory=None):
+        self.cores = cores or cpu_count()
+        # fixed memory limit in megabytes instead of MemAvailable
+        self.memory = memory
+        self.used = {'cpu': 0, 'memory': 0}
+        self.running = 0
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+        self.waiting = []
+
+    def weight(self, weight):
+        weight = dict(self.default_weight, **(weight or {}))
+        return {'cpu': float(weight['cpu']), 'memory': float(weight['memory'])}
+
+    def memory_free(self):
+        """
+        Returns megabytes, which are not reserved by the admitted runs.
+        Admitted runs may already use their memory, so they are counted twice then,
+        but it's better to wait a bit than to starve the running stacks
+        """
+        if self.memory:
+            return self.memory - self.used['memory']
+        return (memory_available() or self.fallback_memory) - self.used['memory']
+
+    def fits(self, weight):
+        if not self.running:
+            return True
+        return (self.used['cpu'] + weight['cpu'] <= self.cores and
+                weight['memory'] <= self.memory_free())
+
+    def acquire(self, weight):
+        """
+        Blocks until the run with weight is admitted. Returns seconds spent in the queue
+        """
+        weight = self.weight(weight)
+        started = time.time()
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiting.append(ticket)
+            while self.waiting[0] != ticket or not self.fits(weight):
+                self.condition.wait(self.poll_interval)
+            self.waiting.pop(0)
+            self.running += 1
+            for key in self.used:
+                self.used[key] += weight[key]
+            # the next run in the queue may fit too
+            self.condition.notify_all()
+        return time.time() - started
+
+    def release(self, weight):
+        weight = self.weight(weight)
+        with self.condition:
+            self.running -= 1
+            for key in self.used:
+                self.used[key] -= weight[key]
+            self.condition.notify_all()
+
+
+class ScheduledRun(object):
+    """
+    Context manager, which runs the block of DockerDialog in its scheduler slot
+    """
+    def __init__(self, ydialog):
+        self.ydialog = ydialog
+        self.weight = ydialog.template_config().get('weight')
+        self.started = None
+
+    def __enter__(self):
+        scheduler = self.ydialog.scheduler
+        if scheduler is not None:
+            with self.ydialog.tracer.span("queue_wait", template=self.ydialog.template):
+                self.ydialog.schedule['queue_wait'] = scheduler.acquire(self.weight)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.ydialog.schedule['run_time'] = time.time() - self.started
+        if self.ydialog.scheduler is not None:
+            self.ydialog.scheduler.release(self.weight)
+        return False
+
+
+def compose_images(compose_path):
+    """
+    Returns list of images, which should be pulled for the compose file.
+    Images of services with build section are built, so they are skipped
+    """
+    import yaml
+    with open(compose_path) as compose_file:
+        compose = yaml.safe_load(compose_file) or {}
+    # compose files of version 1 have services at the top level
+    services = compose_services(compose)
+    images = []
+    for service in (services or {}).values():
+        if not isinstance(service, dict) or 'build' in service or not service.get('image'):
+            continue
+        if service['image'] not in images:
+            images.append(service['image'])
+    return images
+
+
+def image_exists(image):
+    """
+    Checks if docker image is already present locally
+    """
+    with open(os.devnull, 'w') as devnull:
+        return Popen(
+            ["docker", "inspect", "--type=image", image],
+            stdout=devnull, stderr=devnull).wait() == 0
+
+
+def pull_images(images, workers, report=None, pulled=()):
+    """
+    Pulls images, which are not present locally, with at most workers pulls at once.
+    report(image, status) is called on every status change of the image.
+    pulled images were already pulled in background and are only reported.
+    Returns dict with the final status of every image
+    """
+    statuses = {}
+
+    def pull(image):
+        if image in pulled:
+            status = "pulled"
+        elif image_exists(image):
+            status = "present"
+        else:
+            if report is not None:
+                report(image, "pulling")
+            with open(os.devnull, 'w') as devnull:
+                if Popen(["docker", "pull", image], stdout=devnull, stderr=devnull).wait() == 0:
+                    status = "pulled"
+                else:
+                    status = "failed"
+        statuses[image] = status
+        if report is not None:
+            report(image, status)
+
+    run_in_threads(pull, images, workers)
+    return statuses
+
+
+# image lines of compose files, which don't depend on jinja variables
+IMAGE_LINE = re.compile(r"^\s*image:\s*['\"]?([^'\"\s{}]+)['\"]?\s*$", re.MULTILINE)
+
+
+class Cancelled(Exception):
+    """
+    Raised inside of the prefetch, when it was cancelled
+    """
+    pass
+
+
+class CancellableStream(object):
+    """
+    File-like wrapper, which stops reading as soon as cancel event is set
+    """
+    def __init__(self, stream, event):
+        self.stream = stream
+        self.event = event
+
+    def read(self, size=-1):
+        if self.event.is_set():
+            raise Cancelled()
+        return self.stream.read(size)
+
+
+def merge_tree(source, destination):
+    """
+    Moves content of source directory into destination, replacing existing files
+    """
+    for name in os.listdir(source):
+        source_path = os.path.join(source, name)
+        destination_path = os.path.join(destination, name)
+        if os.path.isdir(destination_path) and not os.path.islink(destination_path):
+            if os.path.isdir(source_path) and not os.path.islink(source_path):
+                merge_tree(source_path, destination_path)
+                os.rmdir(source_path)
+                continue
+            rmtree(destination_path)
+        os.rename(source_path, destination_path)
+
+
+class Prefetch(object):
+    """
+    Downloads files, bundle and images of the template in background,
+    while user is entering variables. Bundle is extracted to the bundle store
+    or to the staging directory near template directory, so it may be just
+    linked or moved there later
+    """
+    def __init__(self, ydialog, template):
+        self.ydialog = ydialog
+        self.template = template
+        self.template_config = ydialog.config[ydialog.category]['options'][template]
+        self.files = {}
+        self.bundle_directory = None
+        # bundle_directory is in the bundle store and should never be removed
+        self.bundle_shared = False
+        self.bundle_validators = None
+        self.images = {}
+        self.cancelled = threading.Event()
+        self.processes = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait(self):
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def cancel(self, timeout=1):
+        """
+        Stops prefetch, kills running pulls and removes staging directory
+        """
+        self.cancelled.set()
+        with self.lock:
+            for process in self.processes:
+                if process.poll() is None:
+                    process.terminate()
+        self.thread.join(timeout)
+        self.cleanup()
+
+    def cleanup(self):
+        if self.bundle_directory is not None and not self.bundle_shared:
+            rmtree(self.bundle_directory, ignore_errors=True)
+            self.bundle_directory = None
+
+    def fetch_url(self, entry):
+        if self.cancelled.is_set():
+            raise Cancelled()
+        url = catalog_entry(entry)[0]
+        self.files[url] = self.ydialog.fetch(url)
+
+    def fetch_bundle(self, bundle):
+        response, self.bundle_validators = self.ydialog.open_bundle(
+            bundle, os.path.join(self.ydialog.base_directory, self.template), self.cancelled)
+        if response is None:
+            # bundle in the template directory is up to date
+            return
+        store = self.ydialog.bundle_store
+        if store is not None:
+            try:
+                path = store.lookup(self.bundle_validators) or store.add(
+                    CancellableStream(response, self.cancelled), self.bundle_validators)
+            finally:
+                response.close()
+            self.bundle_directory, self.bundle_shared = path, True
+            return
+        staging = tempfile.mkdtemp(prefix=".docker-dialog-", dir=self.ydialog.base_directory)
+        self.bundle_directory = staging
+        try:
+            extract_tar_stream(CancellableStream(response, self.cancelled), staging)
+        except Exception:
+            rmtree(staging, ignore_errors=True)
+            self.bundle_directory = None
+            raise
+        finally:
+            response.close()
+
+    def pull(self, image):
+        if self.cancelled.is_set() or image_exists(image):
+            return
+        with open(os.devnull, 'w') as devnull:
+            with self.lock:
+                if self.cancelled.is_set():
+                    return
+                process = Popen(["docker", "pull", image], stdout=devnull, stderr=devnull)
+                self.processes.append(process)
+            self.images[image] = "pulled" if process.wait() == 0 else "failed"
+
+    def run(self):
+        tasks = [(self.fetch_url, url) for url in self.template_config.get('urls', [])]
+        if self.template_config.get('bundle'):
+            tasks.append((self.fetch_bundle, bundle_entry(self.template_config)))
+        # failed downloads are repeated by postinstall, so errors are ignored here
+        run_in_threads(lambda task: task[0](task[1]), tasks, self.ydialog.fetch_workers)
+
+        images = []
+        for url, data in self.files.items():
+            if "docker-compose" in url:
+                images.extend(image for image in IMAGE_LINE.findall(data) if image not in images)
+        run_in_threads(self.pull, images, self.ydialog.pull_workers)
+        if self.cancelled.is_set():
+            self.cleanup()
+
+
+def published_port(port):
+    """
+    Returns published (host) part of the compose port entry or None if it isn't published
+    """
+    if isinstance(port, dict):
+        return port.get('published')
+    # "3306", "8080:80", "127.0.0.1:8080:80" or "8080:80/tcp"
+    parts = str(port).split("/")[0].split(":")
+    return parts[-2] if len(parts) > 1 else None
+
+
+def compose_services(compose):
+    """
+    Returns services of parsed compose file, version 1 files have them at the top level
+    """
+    return compose.get('services', compose) if 'version' in compose else compose
+
+
+def compose_ports(compose_path):
+    """
+    Returns dict with the list of host ports, published by every service of the compose file
+    """
+    import yaml
+    with open(compose_path) as compose_file:
+        compose = yaml.safe_load(compose_file) or {}
+    services = compose_services(compose)
+    ports = {}
+    for name, service in (services or {}).items():
+        if not isinstance(service, dict):
+            continue
+        ports[name] = []
+        for port in service.get('ports') or []:
+            try:
+                ports[name].append(int(published_port(port)))
+            except (TypeError, ValueError):
+                # ports without published part or ranges are not probed
+                pass
+    return ports
+
+
+TCP_LISTEN = "0A"
+
+
+def listening_ports():
+    """
+    Returns set of TCP ports, which are listened on the host, read from /proc/net/tcp and tcp6
+    """
+    ports = set()
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as table:
+                # first line is a header
+                next(table, None)
+                for line in table:
+                    # sl local_address rem_address st ...; address is HEXIP:HEXPORT
+                    fields = line.split()
+                    if len(fields) > 3 and fields[3] == TCP_LISTEN:
+                        ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+        except (IOError, ValueError):
+            pass
+    return ports
+
+
+class PortAllocator(object):
+    """
+    Finds free host ports for *_PORT vars. Ports, which were given away
+    by this process, are never given again, so concurrent stacks don't get
+    the same port before their containers start listening.
+    Host ports, published by the compose file of the stack, are claimed
+    by its template directory until the stack is installed or failed
+    """
+    def __init__(self, first=8000, last=65535):
+        self.first = first
+        self.last = last
+        self.reserved = set()
+        # host port -> template directory of the stack, which publishes it
+        self.claimed = {}
+        self.lock = threading.Lock()
+
+    def claim(self, owner, ports):
+        """
+        Reserves host ports for the stack of owner directory.
+        Returns dict with ports, which are claimed by other stacks, and their owners,
+        nothing is reserved then
+        """
+        with self.lock:
+            taken = dict(
+                (port, self.claimed[port]) for port in ports
+                if self.claimed.get(port, owner) != owner)
+            if not taken:
+                for port in ports:
+                    self.claimed[port] = owner
+        return taken
+
+    def release(self, owner):
+        """
+        Releases host ports, claimed by the stack of owner directory
+        """
+        with self.lock:
+            for port, port_owner in self.claimed.items():
+                if port_owner == owner:
+                    del self.claimed[port]
+
+    def allocate(self, count=1):
+        """
+        Returns list of count free ports
+        """
+        listening = listening_ports()
+        ports = []
+        with self.lock:
+            for port in xrange(self.first, self.last + 1):
+                if len(ports) == count:
+                    break
+                if port not in listening and port not in self.reserved and port not in self.claimed:
+                    self.reserved.add(port)
+                    ports.append(port)
+        return ports
+
+
+# service keys, which docker-compose accepts only as lists
+COMPOSE_LISTS = ('ports', 'expose', 'links', 'external_links', 'volumes', 'volumes_from',
+                 'cap_add', 'cap_drop', 'devices')
+# service keys, which may be either list or mapping
+COMPOSE_MAPPINGS = ('environment', 'labels', 'depends_on')
+
+
+def compose_problems(compose_path, listening=frozenset(), own_ports=frozenset()):
+    """
+    Checks rendered compose file before any docker work starts.
+    Returns list of problems: broken YAML, wrong structure of services,
+    wrong or duplicated host ports and host ports, which are already listened.
+    own_ports are published by the previous installation of the same template
+    and are listened by its own containers
+    """
+    import yaml
+    name = os.path.basename(compose_path)
+    try:
+        with open(compose_path) as compose_file:
+            compose = yaml.safe_load(compose_file)
+    except yaml.YAMLError as error:
+        return ["{0} is not valid YAML: {1}".format(name, error)]
+    if not isinstance(compose, dict):
+        return ["{0} should be a mapping of services".format(name)]
+    services = compose_services(compose)
+    if not isinstance(services, dict) or not services:
+        return ["{0} has no services".format(name)]
+    problems = []
+    published = {}
+    for service_name, service in sorted(services.items()):
+        if not isinstance(service, dict):
+            problems.append("Service {0} should be a mapping".format(service_name))
+            continue
+        if not service.get('image') and not service.get('build'):
+            problems.append("Service {0} has neither image nor build".format(service_name))
+        for key in COMPOSE_LISTS:
+            if key in service and not isinstance(service[key], list):
+                problems.append("{0} of service {1} should be a list".format(key, service_name))
+        for key in COMPOSE_MAPPINGS:
+            if key in service and not isinstance(service[key], (list, dict)):
+                problems.append("{0} of service {1} should be a list or mapping".format(key, service_name))
+        if not isinstance(service.get('ports') or [], list):
+            continue
+        for port in service.get('ports') or []:
+            if isinstance(port, int) and port > 65535:
+                # unquoted 22:22 is read by YAML as base 60 number
+                problems.append("Port {0} of service {1} should be quoted".format(port, service_name))
+                continue
+            host_port = published_port(port)
+            if host_port is None or "-" in str(host_port):
+                continue
+            try:
+                host_port = int(host_port)
+                if not 0 < host_port < 65536:
+                    raise ValueError(host_port)
+            except ValueError:
+                problems.append("Service {0} publishes wrong host port {1!r}".format(service_name, port))
+                continue
+            if host_port in published:
+                problems.append("Host port {0} is published by both {1} and {2}".format(
+                    host_port, published[host_port], service_name))
+            elif host_port in listening and host_port not in own_ports:
+                problems.append("Host port {0} of service {1} is already in use".format(
+                    host_port, service_name))
+            published[host_port] = service_name
+    return problems
+
+
+def container_states(directory):
+    """
+    Returns dict with (state, health) of the container of every compose service
+    Health is None for containers without healthcheck
+    """
+    with open(os.devnull, 'w') as devnull:
+        ids = Popen(["docker-compose", "ps", "-q"], stdout=PIPE, stderr=devnull,
+                    cwd=directory).communicate()[0].split()
+        if not ids:
+            return {}
+        output = Popen(["docker", "inspect"] + ids, stdout=PIPE, stderr=devnull).communicate()[0]
+    states = {}
+    try:
+        containers = json.loads(output)
+    except ValueError:
+        return states
+    for container in containers:
+        service = (container.get('Config', {}).get('Labels') or {}).get(
+            'com.docker.compose.service', container.get('Name', '').lstrip('/'))
+        state = container.get('State', {})
+        states[service] = (state.get('Status'), (state.get('Health') or {}).get('Status'))
+    return states
+
+
+class PortProber(object):
+    """
+    Probes TCP ports with non-blocking connects, multiplexed with select.
+    Port is ready, when connection stays open or the service sends something.
+    docker-proxy accepts connections before the application starts and closes
+    them right away, so connection, which is closed immediately, doesn't count.
+    Failed ports are retried with exponential backoff
+    """
+    settle_time = 0.3
+
+    def __init__(self, ports, host="127.0.0.1", min_delay=0.5, max_delay=5):
+        self.host = host
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.ready = set()
+        # port -> [next attempt time, current delay]
+        self.schedule = dict((port, [0, min_delay]) for port in ports)
+        # socket -> (port, connection deadline)
+        self.connecting = {}
+        self.settling = {}
+
+    def _retry(self, port, sock):
+        sock.close()
+        attempt = self.schedule[port]
+        attempt[0] = time.time() + attempt[1]
+        attempt[1] = min(attempt[1] * 2, self.max_delay)
+
+    def poll(self, timeout=1):
+        """
+        Runs probes for at most timeout seconds. Returns set of ready ports
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            busy = set(port for port, _ in self.connecting.values())
+            busy.update(port for port, _ in self.settling.values())
+            for port, attempt in self.schedule.items():
+                if port in self.ready or port in busy or attempt[0] > now:
+                    continue
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                result = sock.connect_ex((self.host, port))
+                if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    self.connecting[sock] = (port, now + self.max_delay)
+                else:
+                    self._retry(port, sock)
+            for sockets in (self.connecting, self.settling):
+                for sock, (port, sock_deadline) in sockets.items():
+                    if sock_deadline <= now:
+                        del sockets[sock]
+                        if sockets is self.settling:
+                            # nobody closed connection - application is listening
+                            self.ready.add(port)
+                            sock.close()
+                        else:
+                            self._retry(port, sock)
+            if now >= deadline or len(self.ready) == len(self.schedule):
+                return self.ready
+            readable, writable, _ = select.select(
+                list(self.settling), list(self.connecting), [],
+                max(0, min(deadline - time.time(), 0.1)))
+            for sock in writable:
+                port, _ = self.connecting.pop(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    self.settling[sock] = (port, time.time() + self.settle_time)
+                else:
+                    self._retry(port, sock)
+            for sock in readable:
+                port, _ = self.settling.pop(sock)
+                try:
+                    data = sock.recv(1)
+                except socket.error:
+                    data = ""
+                if data:
+                    self.ready.add(port)
+                    sock.close()
+                else:
+                    self._retry(port, sock)
+
+
+# docker-compose colors its output, when it thinks it's a terminal
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+# lines of docker-compose output, which tell about progress of the service
+COMPOSE_EVENTS = [
+    (re.compile(r"^Pulling (?P<service>\S+) \("), "pulling"),
+    (re.compile(r"^Building (?P<service>\S+)$"), "building"),
+    (re.compile(r"^(?P<action>Creating|Recreating|Starting) (?P<container>\S+) \.\.\. ?(?P<result>done|error)?"),
+     None),
+    (re.compile(r"^\s*Container (?P<container>\S+)\s+(?P<action>Creating|Created|Recreate|Recreated|"
+                r"Starting|Started|Running|Error)"), None),
+]
+COMPOSE_ACTIONS = {
+    "Creating": "creating", "Recreating": "creating", "Recreate": "creating",
+    "Created": "created", "Recreated": "created",
+    "Starting": "starting", "Started": "started", "Running": "started",
+    "Error": "error",
+}
+
+
+def compose_project(directory):
+    """
+    Returns docker-compose project name, which is prefix of the container names
+    """
+    return re.sub(r"[^a-z0-9]", "", os.path.basename(os.path.normpath(directory)).lower())
+
+
+def parse_compose_line(line, project):
+    """
+    Returns (service, action) for the line of docker-compose output or (None, None)
+    """
+    for pattern, action in COMPOSE_EVENTS:
+        match = pattern.match(line)
+        if not match:
+            continue
+        fields = match.groupdict()
+        if action is None:
+            action = COMPOSE_ACTIONS[fields['action']]
+            if fields.get('result') == "done":
+                # docker-compose up -d reports started containers as done
+                action = "started"
+            elif fields.get('result') == "error":
+                action = "error"
+        service = fields.get('service')
+        if service is None:
+            # containers are named project_service_1 or project-service-1
+            service = re.sub(r"[_-]\d+$", "", fields['container'])
+            for separator in "_-":
+                if service.startswith(project + separator):
+                    service = service[len(project) + 1:]
+        return service, action
+    return None, None
+
+
+def run_compose(command, directory, on_event=None):
+    """
+    Runs docker-compose command and reads stdout and stderr at once with select,
+    so none of the pipes may fill up and block docker-compose.
+    on_event(event) is called for every line of output with dict like
+    {time, stream, line, service, action}.
+    Returns exit code and the list of output lines
+    """
+    process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=directory, close_fds=True)
+    project = compose_project(directory)
+    streams = {process.stdout.fileno(): "stdout", process.stderr.fileno(): "stderr"}
+    buffers = dict((fd, "") for fd in streams)
+    for fd in streams:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    lines = []
+
+    def emit(fd, line):
+        line = ANSI_ESCAPE.sub("", line).rstrip()
+        if not line:
+            return
+        lines.append(line)
+        if on_event is not None:
+            service, action = parse_compose_line(line, project)
+            on_event({
+                'time': time.time(),
+                'stream': streams[fd],
+                'line': line,
+                'service': service,
+                'action': action,
+            })
+
+    open_fds = list(streams)
+    while open_fds:
+        readable, _, _ = select.select(open_fds, [], [])
+        for fd in readable:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError as error:
+                if error.errno == errno.EAGAIN:
+                    continue
+                raise
+            if not chunk:
+                open_fds.remove(fd)
+                if buffers[fd]:
+                    emit(fd, buffers[fd])
+                continue
+            # progress of docker-compose is often updated with carriage return
+            parts = re.split(r"\r\n|\r|\n", buffers[fd] + chunk)
+            buffers[fd] = parts.pop()
+            for part in parts:
+                emit(fd, part)
+    process.stdout.close()
+    process.stderr.close()
+    return process.wait(), lines
+
+
+# magic bytes of the supported bundle compressions and matching tarfile stream modes
+TAR_COMPRESSIONS = [
+    ("\x1f\x8b", "gz"),
+    ("BZh", "bz2"),
+    ("\xfd7zXZ\x00", "xz"),
+]
+
+
+class PeekedStream(object):
+    """
+    File-like wrapper, which returns already consumed head before the rest of stream
+    """
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), ""
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+def extract_tar_stream(stream, path):
+    """
+    Extracts tar archive from non-seekable stream to path without saving archive itself.
+    Compression is detected with magic bytes. tarfile of python2 can't read xz,
+    so such archives are unpacked with xz binary
+    """
+    import tarfile
+    head = stream.read(6)
+    compression = ""
+    for magic, name in TAR_COMPRESSIONS:
+        if head.startswith(magic):
+            compression = name
+    stream = PeekedStream(head, stream)
+    if compression != "xz":
+        with tarfile.open(fileobj=stream, mode="r|" + compression) as tar_archive:
+            tar_archive.extractall(path=path)
+        return
+
+    xz = Popen(["xz", "--decompress", "--stdout"], stdin=PIPE, stdout=PIPE)
+    errors = []
+
+    def feed():
+        try:
+            copyfileobj(stream, xz.stdin)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            xz.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        with tarfile.open(fileobj=xz.stdout, mode="r|") as tar_archive:
+            tar_archive.extractall(path=path)
+    finally:
+        xz.stdout.close()
+        feeder.join()
+        xz.wait()
+    if errors:
+        raise errors[0]
+    if xz.returncode != 0:
+        raise IOError("xz exited with code {0}".format(xz.returncode))
+
+
+class HttpError(IOError):
+    """
+    Raised, when docker repo responds with error status
+    """
+    def __init__(self, url, code, reason):
+        IOError.__init__(self, "HTTP Error {0}: {1} ({2})".format(code, reason, url))
+        self.url = url
+        self.code = code
+
+
+class HttpResponse(object):
+    """
+    Response of HttpSession. Connection goes back to the session pool,
+    when the body is read to the end or the response is closed
+    """
+    def __init__(self, session, key, connection, response, url, started):
+        self.session = session
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+        self.started = started
+        self.bytes = 0
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        if self.response is None:
+            return ""
+        if size is None or size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        self.bytes += len(data)
+        if not data or (size is None or size < 0):
+            self.close()
+        return data
+
+    def close(self):
+        if self.response is None:
+            return
+        # connection may be reused only if the body was read completely
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        self.response = None
+        self.session.release(self.key, self.connection, reusable)
+        self.session.finished(self)
+
+
+class HttpSession(object):
+    """
+    Pool of keep-alive HTTP/1.1 connections for all requests to the docker repo.
+    Failed requests and 5xx responses are retried with jittered exponential backoff.
+    Latency of every request is recorded with tracer as http span
+    """
+    def __init__(self, timeout=15, retries=3, backoff=0.5, tracer=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.tracer = tracer or Tracer()
+        self.pool = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+
+    def acquire(self, key):
+        import httplib
+        with self.lock:
+            self.requests += 1
+            if self.pool.get(key):
+                self.reused += 1
+                return self.pool[key].pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection, reusable):
+        if not reusable:
+            connection.close()
+            return
+        with self.lock:
+            self.pool.setdefault(key, []).append(connection)
+
+    def finished(self, response):
+        if self.tracer.enabled:
+            self.tracer.add("http", response.started, time.time(), {
+                'url': response.url, 'status': response.status, 'bytes': response.bytes})
+
+    def close(self):
+        with self.lock:
+            for connections in self.pool.values():
+                for connection in connections:
+                    connection.close()
+            self.pool = {}
+
+    def sleep_before_retry(self, attempt):
+        time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def get(self, url, headers=None, stream=False, compress=False):
+        """
+        Sends GET request and returns HttpResponse for 2xx and 304 responses.
+        compress asks for gzip content encoding, which is decoded for non-stream
+        responses. Without stream the body is read at once and connection is released.
+        Raises HttpError for error responses and IOError, when repo is unreachable
+        """
+        headers = dict(headers or {})
+        if compress and not stream:
+            headers['Accept-Encoding'] = "gzip"
+        for redirect in range(5):
+            response = self._get(url, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+                response.read()
+                url = urljoin(url, response.headers['Location'])
+                continue
+            break
+        if response.status >= 400:
+            reason = response.response.reason
+            response.read()
+            raise HttpError(url, response.status, reason)
+        if not stream:
+            data = response.read()
+            if response.headers.get('Content-Encoding') == "gzip":
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            response.content = data
+        return response
+
+    def _get(self, url, headers):
+        import httplib
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        attempt = 0
+        while True:
+            connection, reused = self.acquire(key)
+            started = time.time()
+            try:
+                connection.request("GET", path, headers=headers)
+                raw = connection.getresponse()
+            except (socket.error, httplib.HTTPException) as error:
+                connection.close()
+                # server may close idle keep-alive connection, so it's retried at once
+                if reused:
+                    continue
+                if attempt >= self.retries:
+                    raise IOError("Failed to load {0}: {1}".format(url, error))
+                self.sleep_before_retry(attempt)
+                attempt += 1
+                continue
+            response = HttpResponse(self, key, connection, raw, url, started)
+            if response.status >= 500 and attempt < self.retries:
+                response.read()
+                self.sleep_before_retry(attempt)
+                attempt += 1
+                continue
+            return response
+
+
+class HashingStream(object):
+    """
+    File-like wrapper, which calculates sha256 of the data read from the stream
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        # tar reader may stop before the end of compressed stream
+        for chunk in iter(lambda: self.read(65536), ""):
+            pass
+        return self.digest.hexdigest()
+
+
+class IntegrityError(IOError):
+    """
+    Raised, when downloaded file doesn't match sha256 or size from docker.yml
+    """
+
+
+def catalog_entry(entry):
+    """
+    Returns (url, checks) for url or bundle entry of docker.yml.
+    Entry is either url or dict with url and optional sha256 and size keys
+    """
+    if isinstance(entry, dict):
+        return entry['url'], dict(
+            (key, entry[key]) for key in ('sha256', 'size') if entry.get(key) is not None)
+    return entry, {}
+
+
+def bundle_entry(options):
+    """
+    Returns bundle entry of the template options for catalog_entry.
+    bundle stays plain url in docker.yml, so older clients can still read it,
+    its sha256 and size are set with bundle_sha256 and bundle_size keys
+    """
+    bundle = options.get('bundle')
+    checks = dict(
+        (key, options['bundle_' + key]) for key in ('sha256', 'size')
+        if options.get('bundle_' + key) is not None)
+    if bundle and checks and not isinstance(bundle, dict):
+        return dict(checks, url=bundle)
+    return bundle
+
+
+def check_integrity(url, checks, size, sha256):
+    if 'size' in checks and size != int(checks['size']):
+        raise IntegrityError("Size mismatch for {0}: expected {1}, got {2} bytes".format(
+            url, checks['size'], size))
+    if 'sha256' in checks and sha256 != checks['sha256'].lower():
+        raise IntegrityError("sha256 mismatch for {0}: expected {1}, got {2}".format(
+            url, checks['sha256'], sha256))
+
+
+# partial downloads, which weren't resumed for so long, are removed, seconds
+DOWNLOAD_MAX_AGE = 7 * 24 * 3600
+
+
+def response_validator(response):
+    """
+    Returns ETag or Last-Modified of the response for If-Range, weak ETag can't be used there
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def clean_downloads(directory, max_age=DOWNLOAD_MAX_AGE):
+    """
+    Removes partial and verified downloads, which weren't touched for max_age seconds,
+    like partial files of the bundle versions, which were replaced in docker.yml.
+    Lock files are kept, because another installation may hold them
+    """
+    deadline = time.time() - max_age
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(".lock"):
+            continue
+        try:
+            if os.path.getmtime(path) < deadline:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+def download_file(session, url, path, checks, cancelled=None):
+    """
+    Downloads url to path and verifies it with checks while data streams in.
+    Data goes to path.part first: broken download is resumed with Range request
+    from the last received byte, by the retries of this call or by the next call.
+    ETag or Last-Modified of the partial file is sent in If-Range, so server sends
+    the whole file, if it was changed meanwhile. Partial file without them is resumed
+    only if sha256 is known. Partial file is read once on resume, because hash state
+    can't be saved. Raises IntegrityError and removes partial file if the result doesn't match
+    """
+    import httplib
+    part_path = path + ".part"
+    validator_path = part_path + ".validator"
+    attempt = 0
+    while True:
+        digest = hashlib.sha256()
+        offset = 0
+        validator = None
+        if os.path.exists(validator_path):
+            with open(validator_path) as validator_file:
+                validator = validator_file.read().strip() or None
+        if os.path.exists(part_path) and validator is None and 'sha256' not in checks:
+            # bytes of another version of the file would pass the size check
+            os.unlink(part_path)
+        if os.path.exists(part_path):
+            with open(part_path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(65536), ""):
+                    digest.update(chunk)
+                    offset += len(chunk)
+        if 'size' in checks and offset > int(checks['size']):
+            os.unlink(part_path)
+            continue
+        try:
+            headers = {}
+            if offset:
+                headers['Range'] = "bytes={0}-".format(offset)
+                if validator is not None:
+                    headers['If-Range'] = validator
+            try:
+                response = session.get(url, headers=headers, stream=True)
+            except HttpError as error:
+                # partial file is already complete
+                if error.code != 416 or not offset:
+                    raise
+                response = None
+            if response is not None:
+                try:
+                    mode = 'ab'
+                    if response.status != 206:
+                        # server ignored the range or the file was changed, it sends the whole file
+                        mode, offset, digest = 'wb', 0, hashlib.sha256()
+                        validator = response_validator(response)
+                        with open(validator_path, 'w') as validator_file:
+                            validator_file.write(validator or "")
+                    length = response.headers.get('Content-Length')
+                    end = offset + int(length) if length and length.isdigit() else None
+                    with open(part_path, mode) as part_file:
+                        for chunk in iter(lambda: response.read(65536), ""):
+                            if cancelled is not None and cancelled.is_set():
+                                raise Cancelled()
+                            digest.update(chunk)
+                            offset += len(chunk)
+                            part_file.write(chunk)
+                            if 'size' in checks and offset > int(checks['size']):
+                                break
+                    # httplib returns short body without error, when connection breaks
+                    if end is not None and offset < end:
+                        raise IOError("Connection to {0} was closed after {1} of {2} bytes".format(
+                            url, offset, end))
+                finally:
+                    response.close()
+        except (socket.error, httplib.HTTPException, IOError) as error:
+            # data received so far stays in the partial file for the next attempt
+            if isinstance(error, HttpError) or attempt >= session.retries:
+                raise
+            session.sleep_before_retry(attempt)
+            attempt += 1
+            continue
+        try:
+            check_integrity(url, checks, offset, digest.hexdigest())
+        except IntegrityError:
+            os.unlink(part_path)
+            if os.path.exists(validator_path):
+                os.unlink(validator_path)
+            raise
+        os.rename(part_path, path)
+        if os.path.exists(validator_path):
+            os.unlink(validator_path)
+        return path
+
+
+class DownloadLock(object):
+    """
+    Context manager, which holds exclusive flock of path.lock while the file is
+    downloaded, opened or removed. flock works between threads of one process too,
+    because every holder opens the lock file itself
+    """
+    def __init__(self, path):
+        self.lock_path = path + ".lock"
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+        return False
+
+
+class DownloadedArchive(object):
+    """
+    Verified archive from the downloads directory, opened for extraction.
+    Every installation reads it with its own handle. The file is removed, when
+    the handle is closed: the bundle is in the store by then, or the next
+    installation downloads it again
+    """
+    def __init__(self, path):
+        self.path = path
+        self.archive = open(path, 'rb')
+
+    def read(self, size=-1):
+        return self.archive.read(size)
+
+    def close(self):
+        if self.archive.closed:
+            return
+        self.archive.close()
+        with DownloadLock(self.path):
+            try:
+                os.unlink(self.path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+
+class BundleStore(object):
+    """
+    Content-addressed store of extracted bundles, shared by all templates.
+    Every bundle is extracted once to the directory named by sha256 of the archive,
+    template directories get copies of its files, made with cp --reflink=auto,
+    so copy-on-write filesystems share data blocks until the file is changed.
+    link_mode "hardlink" links files instead, which is faster and shares disk
+    space everywhere, but hardlinked files share the inode with the store:
+    in place edit, chown or chmod from a container changes the stored bundle
+    and every other installation of it. Use it only for bundles, which are never changed
+    """
+    def __init__(self, directory, link_mode="copy"):
+        self.directory = directory
+        self.link_mode = link_mode
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _key(self, validators):
+        return json.dumps(
+            sorted((name, value) for name, value in validators.items() if value), sort_keys=True)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except (IOError, ValueError):
+            return {}
+
+    def lookup(self, validators):
+        """
+        Returns path of the extracted bundle with these HTTP validators or None
+        """
+        if not validators or not (validators.get('etag') or validators.get('last_modified') or
+                                  validators.get('sha256')):
+            return None
+        # bundle with known sha256 is stored under its digest
+        digest = validators.get('sha256') or self._load_index().get(self._key(validators))
+        if digest and os.path.isdir(os.path.join(self.directory, digest)):
+            return os.path.join(self.directory, digest)
+        return None
+
+    def add(self, stream, validators):
+        """
+        Extracts bundle from the stream to the store, returns path of the extracted bundle
+        """
+        staging = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        hashing = HashingStream(stream)
+        try:
+            extract_tar_stream(hashing, staging)
+            digest = hashing.hexdigest()
+        except Exception:
+            rmtree(staging, ignore_errors=True)
+            raise
+        path = os.path.join(self.directory, digest)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # the same bundle was stored by another installation meanwhile
+            rmtree(staging, ignore_errors=True)
+        with self.lock:
+            index = self._load_index()
+            index[self._key(validators)] = digest
+            tmp_path = "{0}.{1}.tmp".format(self.index_path, os.getpid())
+            with open(tmp_path, 'w') as index_file:
+                json.dump(index, index_file)
+            os.rename(tmp_path, self.index_path)
+        return path
+
+    def link(self, path, destination):
+        """
+        Fills destination with files of the extracted bundle
+        """
+        if self.link_mode == "hardlink":
+            try:
+                self._hardlink(path, destination)
+                return
+            except OSError as error:
+                if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        with open(os.devnull, 'w') as devnull:
+            if Popen(["cp", "-a", "--reflink=auto", os.path.join(path, "."), destination],
+                     stderr=devnull).wait() == 0:
+                return
+        self._copy(path, destination)
+
+    def _walk(self, path, destination, handler):
+        for root, _, files in os.walk(path):
+            target_root = os.path.join(destination, os.path.relpath(root, path))
+            if not os.path.isdir(target_root):
+                os.makedirs(target_root)
+            for name in files:
+                source = os.path.join(root, name)
+                target = os.path.join(target_root, name)
+                if os.path.lexists(target):
+                    os.unlink(target)
+                if os.path.islink(source):
+                    os.symlink(os.readlink(source), target)
+                else:
+                    handler(source, target)
+
+    def _hardlink(self, path, destination):
+        self._walk(path, destination, os.link)
+
+    def _copy(self, path, destination):
+        self._walk(path, destination, copy2)
+
+
+class UrlCache(object):
+    """
+    On-disk cache for files from our docker repo, keyed by URL
+    Stored files are revalidated with ETag/Last-Modified conditional requests
+    and least recently used ones are evicted, when cache grows over max_size
+    In offline mode files are served from the cache only
+    """
+    def __init__(self, cache_directory, max_size=50 * 1024 * 1024, offline=False, ttl=0,
+                 session=None):
+        self.cache_directory = cache_directory
+        self.session = session or HttpSession()
+        self.data_directory = os.path.join(cache_directory, "data")
+        self.index_path = os.path.join(cache_directory, "index.json")
+        self.max_size = max_size
+        self.offline = offline
+        # entries younger than ttl seconds are served without revalidation
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # access times of the read entries are saved with the next stored file or by flush()
+        self.dirty = False
+        if not os.path.exists(self.data_directory):
+            os.makedirs(self.data_directory)
+        try:
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+        except (IOError, ValueError):
+            self.index = {}
+
+    def _data_path(self, url):
+        return os.path.join(self.data_directory, hashlib.sha1(url).hexdigest())
+
+    def _save_index(self):
+        # writing index to the temporary file first, so it's never left broken
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.rename(tmp_path, self.index_path)
+        self.dirty = False
+
+    def flush(self):
+        """
+        Saves access times of the entries, which were only read
+        """
+        with self.lock:
+            if self.dirty:
+                self._save_index()
+
+    def _read(self, url):
+        """
+        Returns cached content and marks it as recently used
+        """
+        with open(self._data_path(url), 'rb') as data_file:
+            data = data_file.read()
+        with self.lock:
+            if url in self.index:
+                self.index[url]['atime'] = time.time()
+                self.dirty = True
+        return data
+
+    def _store(self, url, data, headers):
+        with self.lock:
+            tmp_path = "{0}.{1}.tmp".format(self._data_path(url), threading.current_thread().ident)
+            with open(tmp_path, 'wb') as data_file:
+                data_file.write(data)
+            os.rename(tmp_path, self._data_path(url))
+            now = time.time()
+            self.index[url] = {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'size': len(data),
+                'atime': now,
+                'mtime': now,
+            }
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        """
+        Removes least recently used entries until cache fits into max_size
+        Should be called with self.lock held
+        """
+        total = sum(entry['size'] for entry in self.index.values())
+        for url, entry in sorted(self.index.items(), key=lambda item: item[1]['atime']):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(self._data_path(url))
+            except OSError:
+                pass
+            total -= entry['size']
+            del self.index[url]
+
+    def get(self, url):
+        """
+        Returns content of the url, downloading it only if cached copy is stale
+        """
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is not None and not os.path.exists(self._data_path(url)):
+                del self.index[url]
+                entry = None
+        if self.offline:
+            if entry is None:
+                raise IOError("{0} is not cached and offline mode is enabled".format(url))
+            return self._read(url)
+        if entry is not None and time.time() - entry.get('mtime', 0) < self.ttl:
+            return self._read(url)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self.session.get(url, headers=headers, compress=True)
+        except HttpError:
+            raise
+        except IOError:
+            # repo is unreachable - stale copy is better than nothing
+            if entry is not None:
+                return self._read(url)
+            raise
+        if response.status == 304 and entry is not None:
+            with self.lock:
+                entry['mtime'] = time.time()
+                self.dirty = True
+            return self._read(url)
+        self._store(url, response.content, response.headers)
+        return response.content
+
+
+class PackMember(object):
+    """
+    File-like reader of the catalog pack member, which doesn't copy the whole member
+    """
+    def __init__(self, data, start, size):
+        self.data = data
+        self.position = start
+        self.end = start + size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.end - self.position
+        size = min(size, self.end - self.position)
+        chunk = self.data[self.position:self.position + size]
+        self.position += size
+        return chunk
+
+    def close(self):
+        pass
+
+
+class CatalogPack(object):
+    """
+    Single file with docker.yml and all files of the templates.
+    File starts with PACK_MAGIC and length of the JSON index, which maps names
+    (URLs relative to the docker repo) to offset, size and sha256 of the member.
+    Members follow the index, offsets are counted from the end of the index.
+    Pack is mapped into memory, so reading a member doesn't unpack anything else
+    """
+    header = struct.Struct(">8sQ")
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as pack_file:
+            self.data = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_size = self.header.unpack(self.data[:self.header.size])
+        if magic != PACK_MAGIC:
+            raise IOError("{0} is not a catalog pack".format(path))
+        self.data_start = self.header.size + index_size
+        self.index = json.loads(self.data[self.header.size:self.data_start])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def read(self, name):
+        member = self.index[name]
+        start = self.data_start + member['offset']
+        return self.data[start:start + member['size']]
+
+    def open(self, name):
+        member = self.index[name]
+        return PackMember(self.data, self.data_start + member['offset'], member['size'])
+
+
+PACK_MAGIC = "DDPACK1\n"
+
+
+def pack_members(root):
+    """
+    Returns names of all files from root, which are referenced by docker.yml
+    """
+    import yaml
+    with open(os.path.join(root, "docker.yml")) as catalog_file:
+        catalog = yaml.safe_load(catalog_file)
+    names = ["docker.yml"]
+    if os.path.exists(os.path.join(root, "README")):
+        names.append("README")
+    for section in catalog.values():
+        for options in section['options'].values():
+            entries = options.get('urls', []) + [options.get('bundle'), options.get('help')]
+            for name in [catalog_entry(entry)[0] for entry in entries if entry]:
+                if name and name not in names and os.path.isfile(os.path.join(root, name)):
+                    names.append(name)
+    return names
+
+
+def build_pack(root, output):
+    """
+    Creates catalog pack with docker.yml and files of all templates from root directory
+    """
+    index = {}
+    offset = 0
+    names = pack_members(root)
+    for name in names:
+        with open(os.path.join(root, name), 'rb') as member_file:
+            digest = hashlib.sha256(member_file.read()).hexdigest()
+        size = os.path.getsize(os.path.join(root, name))
+        index[name] = {'offset': offset, 'size': size, 'sha256': digest}
+        offset += size
+    index_data = json.dumps(index, sort_keys=True)
+    tmp_path = output + ".tmp"
+    with open(tmp_path, 'wb') as pack_file:
+        pack_file.write(CatalogPack.header.pack(PACK_MAGIC, len(index_data)))
+        pack_file.write(index_data)
+        for name in names:
+            with open(os.path.join(root, name), 'rb') as member_file:
+                copyfileobj(member_file, pack_file)
+    os.rename(tmp_path, output)
+    return names
+
+
+def download_pack(url, path, session):
+    """
+    Downloads catalog pack to path, unless the local copy is still valid
+    Validators of the local copy are kept next to it in .validators file
+    """
+    validators_path = path + ".validators"
+    headers = {}
+    if os.path.exists(path) and os.path.exists(validators_path):
+        with open(validators_path) as validators_file:
+            validators = json.load(validators_file)
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    try:
+        response = session.get(url, headers=headers, stream=True)
+    except HttpError:
+        raise
+    except IOError:
+        if os.path.exists(path):
+            return path
+        raise
+    try:
+        if response.status == 304:
+            return path
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as pack_file:
+            copyfileobj(response, pack_file)
+    finally:
+        response.close()
+    os.rename(tmp_path, path)
+    with open(validators_path, 'w') as validators_file:
+        json.dump({
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }, validators_file)
+    return path
+
+
+class CatalogIndex(object):
+    """
+    Parsed docker.yml with precomputed menus and search index.
+    Index is cached as JSON next to the url cache, keyed by sha256 of docker.yml,
+    so large catalogs are parsed with YAML loader only when they change
+    """
+    version = 1
+
+    def __init__(self, config, categories, templates, tokens):
+        self.config = config
+        # menu choices: [(category, description)] and {category: [(template, desc)]}
+        self.categories = categories
+        self.templates = templates
+        # sorted tokens from names and descriptions -> ["category/template", ...]
+        self.tokens = tokens
+        self.token_list = sorted(tokens)
+
+    @classmethod
+    def build(cls, config):
+        categories = []
+        templates = {}
+        tokens = {}
+        for category, section in sorted(config.items()):
+            categories.append((category, section.get('description', "")))
+            templates[category] = []
+            for template, options in sorted(section['options'].items()):
+                templates[category].append((template, options.get('desc', "")))
+                name = "{0}/{1}".format(category, template)
+                text = " ".join([category, template, options.get('desc', "")])
+                for token in set(re.findall(r"[a-z0-9]+", text.lower())):
+                    tokens.setdefault(token, []).append(name)
+        return cls(config, categories, templates, tokens)
+
+    @classmethod
+    def load(cls, data, cache_directory=None):
+        """
+        Returns index of docker.yml content, loading it from the cache if it's there
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(cache_directory, "catalog.json") if cache_directory else None
+        if path:
+            try:
+                with open(path) as index_file:
+                    cached = json.load(index_file)
+                if cached.get('sha256') == digest and cached.get('version') == cls.version:
+                    return cls(cached['config'], [tuple(item) for item in cached['categories']],
+                               dict((category, [tuple(item) for item in items])
+                                    for category, items in cached['templates'].items()),
+                               cached['tokens'])
+            except (IOError, ValueError, KeyError):
+                pass
+        import yaml
+        # libyaml loader is much faster, but it may be not compiled in
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        index = cls.build(yaml.load(data, Loader=loader))
+        if path:
+            tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+            try:
+                with open(tmp_path, 'w') as index_file:
+                    json.dump({
+                        'sha256': digest,
+                        'version': cls.version,
+                        'config': index.config,
+                        'categories': index.categories,
+                        'templates': index.templates,
+                        'tokens': index.tokens,
+                    }, index_file)
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                pass
+        return index
+
+    def search(self, query):
+        """
+        Returns [(category, template, desc)] of templates, which match every word
+        of the query by prefix of their name, category or description
+        """
+        matches = None
+        for word in re.findall(r"[a-z0-9]+", query.lower()):
+            names = set()
+            position = bisect.bisect_left(self.token_list, word)
+            while position < len(self.token_list) and self.token_list[position].startswith(word):
+                names.update(self.tokens[self.token_list[position]])
+                position += 1
+            matches = names if matches is None else matches & names
+        results = []
+        for name in sorted(matches or []):
+            category, _, template = name.partition("/")
+            results.append((category, template, self.config[category]['options'][template].get('desc', "")))
+        return results
+
+
+# file in template directory with hashes of the installed files and services
+STATE_FILE = ".docker-dialog.json"
+
+
+def load_state(directory):
+    """
+    Returns state of the previous installation to directory or empty dict
+    """
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def file_hash(path):
+    """
+    Returns sha256 of the file or None if it doesn't exist
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as hashed_file:
+            for chunk in iter(lambda: hashed_file.read(65536), ""):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def service_hashes(compose_path):
+    """
+    Returns dict with sha256 of the definition of every service of the compose file
+    """
+    import yaml
+    with open(compose_path) as compose_file:
+        compose = yaml.safe_load(compose_file) or {}
+    services = compose_services(compose)
+    return dict(
+        (name, hashlib.sha256(json.dumps(service, sort_keys=True)).hexdigest())
+        for name, service in (services or {}).items())
+
+
+def dockerignore_patterns(context):
+    """
+    Returns patterns from .dockerignore of the build context
+    """
+    try:
+        with open(os.path.join(context, ".dockerignore")) as ignore_file:
+            lines = [line.strip() for line in ignore_file]
+    except IOError:
+        return []
+    return [line.rstrip("/") for line in lines if line and not line.startswith("#")]
+
+
+def context_hash(context, dockerfile, args, exclude):
+    """
+    Returns sha256 of the Dockerfile, build args and all files of the build context.
+    Paths from exclude and .dockerignore are skipped with everything inside them
+    """
+    patterns = list(exclude) + dockerignore_patterns(context)
+
+    def ignored(path):
+        parts = path.split(os.sep)
+        return any(
+            fnmatch.fnmatch(os.sep.join(parts[:depth]), pattern)
+            for pattern in patterns for depth in range(1, len(parts) + 1))
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(args, sort_keys=True))
+    with open(os.path.join(context, dockerfile), 'rb') as dockerfile_file:
+        digest.update(dockerfile_file.read())
+    for root, directories, files in os.walk(context):
+        relative_root = os.path.relpath(root, context)
+        directories[:] = sorted(
+            name for name in directories
+            if not ignored(os.path.normpath(os.path.join(relative_root, name))))
+        for name in sorted(files):
+            relative = os.path.normpath(os.path.join(relative_root, name))
+            if ignored(relative):
+                continue
+            digest.update(relative + "\0")
+            path = os.path.join(root, name)
+            digest.update(os.readlink(path) if os.path.islink(path) else file_hash(path))
+    return digest.hexdigest()
+
+
+def build_args(build):
+    """
+    Returns build args of the compose build section as dict
+    """
+    args = build.get('args') or {} if isinstance(build, dict) else {}
+    if isinstance(args, list):
+        args = dict(arg.split("=", 1) if "=" in arg else (arg, "") for arg in args)
+    return args
 
 
 class DockerDialog(object):
@@ -19,201 +1982,602 @@ class DockerDialog(object):
     URL with our docker repo and config should be provided during class init with base_url
     As a result you will recieve running docker container. It doesn't return anything
     """
-    def __init__(self, base_url):
-        self.dialog = Dialog()
-        self.dialog.set_background_title("Docker composing")
+    def __init__(self, base_url, fetch_workers=4, cache=None, headless=False, pull_workers=3,
+                 ready_timeout=300, event_log=None, tracer=None, pack=None, session=None,
+                 bundle_store=None, scheduler=None):
+        # there is no dialog in headless mode, templates are installed with self.provision()
+        self.dialog = None
+        if not headless:
+            from dialog import Dialog
+            self.dialog = Dialog()
+            self.dialog.set_background_title("Docker composing")
         self.base_url = base_url
+        # spans of provisioning stages are recorded only if tracer is enabled
+        self.tracer = tracer or Tracer()
         self.template = ""
         self.category = ""
         self.template_directory = ""
         self.base_directory = os.path.expanduser("~")
         self.stage = 0
         self.vars = {}
-        self.binaries = ["docker", "docker-compose", "dialog"]
-        self.check_requirments()
+        self.binaries = ["docker", "docker-compose"]
+        if not headless:
+            self.binaries.append("dialog")
+        # how many files of a template are downloaded at once
+        self.fetch_workers = fetch_workers
+        # how many docker images are pulled at once before docker-compose up
+        self.pull_workers = pull_workers
+        # statuses of pulled images of the installed template
+        self.images = {}
+        # how long to wait for containers to become ready after docker-compose up
+        self.ready_timeout = ready_timeout
+        self.readiness = {}
+        # JSON lines file, where docker-compose progress events are written
+        self.event_log = event_log
+        self.event_log_lock = threading.Lock()
+        # background download of the selected template and its results
+        self.prefetch = None
+        self.prefetched = {}
+        self.prefetched_bundle = None
+        self.prefetched_bundle_validators = None
+        self.prefetched_bundle_shared = False
+        # statuses of the images, pulled by prefetch
+        self.prefetched_images = {}
+        # hashes of the previous and current installation to template_directory
+        self.previous_state = {}
+        self.state = {'files': {}}
+        self.changed_files = set()
+        # UrlCache instance, files are always downloaded if it's not set
+        self.cache = cache
+        # keep-alive connections to the docker repo, shared with the cache
+        self.session = session or (cache.session if cache is not None else HttpSession(tracer=self.tracer))
+        # CatalogPack instance, files from it are never downloaded
+        self.pack = pack
+        # BundleStore instance, bundles are extracted to every template directory without it
+        self.bundle_store = bundle_store
+        # ResourceScheduler instance, which is shared by concurrent stacks
+        self.scheduler = scheduler
+        # seconds of the installed template spent in the scheduler queue and in docker-compose
+        self.schedule = {'queue_wait': 0, 'run_time': 0}
+        # free host ports for *_PORT vars, shared by concurrent stacks
+        self.ports = PortAllocator()
+        # ports, which were assigned to the port vars, that were not given in headless mode
+        self.assigned_ports = {}
+        # sources of downloaded jinja templates, keyed by url; concurrent stacks
+        # share them, so the source is stored and loaded under the lock
+        self.sources = {}
+        self.sources_lock = threading.Lock()
+        # jinja environment is created on the first render or for the first stack,
+        # because jinja2 is slow to import and isn't needed until files are loaded
+        self.jinja = None
+        with self.tracer.span("check_requirments"):
+            self.check_requirments()
+        if headless:
+            self.load_catalog()
+            return
         try:
             if self.dialog.yesno(
                 "Do you want to create Docker container from the list of preinstalled images?",
                 width=50
             ) == self.dialog.DIALOG_OK:
                 self.dialog.infobox("Loading list of templates", title="Loading...", height=5)
-                self.config = yaml.load(urlopen(urljoin(self.base_url, "docker.yml")))
+                self.load_catalog()
                 # self.category_window()
             else:
                 self.dialog_exit(manually=True)
         except KeyboardInterrupt:
             self.dialog_exit(manually=True)
 
+    def load_catalog(self):
+        """
+        Loads docker.yml to self.config and its menus and search index to self.catalog
+        """
+        with self.tracer.span("catalog"):
+            self.catalog = CatalogIndex.load(
+                self.fetch("docker.yml"), self.cache.cache_directory if self.cache else None)
+            self.config = self.catalog.config
+
     def check_requirments(self):
         """
         Function, that checks if required bineries exist within $PATH
         """
-        for program in self.binaries:
-            exists = 0
-            for path in os.environ["PATH"].split(os.pathsep):
-                path = path.strip('"')
-                exe_file = os.path.join(path, program)
-                if os.path.isfile(exe_file) and os.access(exe_file, os.X_OK):
-                    exists = 1
-            if exists == 0:
-                self.dialog_exit(manually="binary")
+        found = find_binaries(self.binaries)
+        missing = [program for program in self.binaries if program not in found]
+        if missing:
+            if self.dialog is None:
+                raise ProvisionError(
+                    "Required binaries {0} are not found within $PATH".format(", ".join(missing)))
+            self.dialog_exit(manually="binary", missing=missing)
         return None
 
-    def dialog_exit(self, manually=False):
+    def dialog_exit(self, manually=False, missing=None):
         """
-        Runned in case of user exit from dialog
+        Runned in case of user exit from dialog.
+        missing is the list of binaries, which were not found, for manually="binary"
         """
+        self.cancel_prefetch()
         if manually is False:
-            self.dialog.infobox(
-                """Script ends normally.
-It may take several minutes to initialize an application inside the Docker container.
+            # containers are already running, so message is left in the terminal instead of waiting
+            os.system('clear')
+            print """Script ends normally.
 
 You may run this script anytime with the command:
-                docker-dialog""",
-                title="Exiting...",
-                width=50
-                )
-            time.sleep(5)
-            os.system('clear')
+                docker-dialog"""
             raise SystemExit(0)
 
         elif manually is True:
-            self.dialog.infobox(
+            # message stays for 5 seconds, unless user dismisses it
+            self.dialog.pause(
                 """Script stops on user request.
 
 You may run this script anytime with the command:
                 docker-dialog""",
                 title="Exiting...",
-                width=50
+                width=50,
+                height=12,
+                seconds=5
                 )
-            time.sleep(5)
             os.system('clear')
             raise SystemExit(0)
         elif manually == "binary":
-            self.dialog.infobox(
+            self.dialog.pause(
                 """Script stops as it didn't find required binaries.
 
 Please, check that listed binaries are installed within $PATH:
-        {0}""".format(self.binaries),
+        {0}""".format(", ".join(missing or self.binaries)),
                 title="Required binaries not found...",
-                width=50
+                width=50,
+                height=12,
+                seconds=5
                 )
-            time.sleep(5)
             os.system('clear')
             raise SystemExit(0)
         else:
             # TODO: This part of the script will never happen...
-            self.dialog.infobox(
+            self.dialog.pause(
                 """Script exits abnormally.
 
 Please, contact support or try run script one more time with the command:
                 docker-dialog""",
                 title="Exiting...",
-                width=50
+                width=50,
+                height=12,
+                seconds=5
                 )
-            time.sleep(5)
             os.system('clear')
             raise SystemExit(1)
 
+    def jinja_environment(self):
+        """
+        Creates jinja Environment, shared by all templates of this instance.
+        Templates are loaded from self.sources, compiled bytecode is stored
+        in the cache directory and reused while template source is unchanged
+        """
+        from jinja2 import Environment, FunctionLoader, FileSystemBytecodeCache
+        bytecode_cache = None
+        if self.cache is not None:
+            bytecode_directory = os.path.join(self.cache.cache_directory, "jinja")
+            if not os.path.exists(bytecode_directory):
+                os.makedirs(bytecode_directory)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_directory)
+        return Environment(
+            autoescape=True,
+            loader=FunctionLoader(self.template_source),
+            bytecode_cache=bytecode_cache)
+
+    def template_source(self, url):
+        """
+        Jinja loader function, returns source of the already downloaded template
+        """
+        source = self.sources.get(url)
+        if source is None:
+            return None
+        # template compiled from old source should be reloaded, when it's changed;
+        # source is decoded again on every download, so it's compared by value
+        return source, url, lambda: self.sources.get(url) == source
+
+    def fetch(self, url):
+        """
+        Returns content of the file from our docker repo, using cache if it's enabled
+        """
+        full_url = urljoin(self.base_url, url)
+        with self.tracer.span("fetch", url=url) as span:
+            if self.pack is not None and url in self.pack:
+                data = self.pack.read(url)
+            elif self.cache is not None:
+                data = self.cache.get(full_url)
+            else:
+                data = self.session.get(full_url, compress=True).content
+            span.set(bytes=len(data))
+        return data
+
+    def open_bundle(self, bundle, directory, cancelled=None):
+        """
+        Opens bundle entry for extraction to directory.
+        Returns (stream, validators), stream is None if the bundle, which was
+        extracted there by the previous installation, is still up to date.
+        Bundle with sha256 or size is downloaded and verified before it's opened
+        """
+        bundle, checks = catalog_entry(bundle)
+        previous = load_state(directory).get('bundle') or {}
+        if previous.get('url') != bundle:
+            previous = {}
+        if self.pack is not None and bundle in self.pack:
+            validators = {'url': bundle, 'sha256': self.pack.index[bundle]['sha256']}
+            check_integrity(bundle, checks, self.pack.index[bundle]['size'], validators['sha256'])
+            if previous.get('sha256') == validators['sha256']:
+                return None, previous
+            return self.pack.open(bundle), validators
+        if checks:
+            validators = {'url': bundle, 'sha256': checks.get('sha256'), 'size': checks.get('size')}
+            if checks.get('sha256') and previous.get('sha256') == checks['sha256']:
+                return None, previous
+            downloads = os.path.join(
+                self.cache.cache_directory if self.cache else tempfile.gettempdir(), "downloads")
+            if not os.path.exists(downloads):
+                try:
+                    os.makedirs(downloads)
+                except OSError as error:
+                    if error.errno != errno.EEXIST:
+                        raise
+            clean_downloads(downloads)
+            path = os.path.join(downloads, checks.get('sha256') or hashlib.sha1(bundle).hexdigest())
+            # concurrent installations of the bundle wait here for the one, which downloads it
+            with DownloadLock(path):
+                if self.bundle_store is not None and self.bundle_store.lookup(validators):
+                    # already extracted to the store, so there is nothing to download,
+                    # callers look the bundle up in the store before reading the stream
+                    return open(os.devnull, 'rb'), validators
+                if not os.path.exists(path):
+                    download_file(
+                        self.session, urljoin(self.base_url, bundle), path, checks, cancelled)
+                return DownloadedArchive(path), validators
+        headers = {}
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+        response = self.session.get(urljoin(self.base_url, bundle), headers=headers, stream=True)
+        if response.status == 304:
+            response.close()
+            return None, previous
+        return response, {
+            'url': bundle,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
     def dialog_help(self, url='README'):
         """
         Runned in case of asking for a help. It should be read from README file
         """
-        help_msg = urlopen(urljoin(self.base_url, url)).read()
+        help_msg = self.fetch(url)
         self.dialog.msgbox(
             help_msg,
             width=100,
             title="Help")
 
-    def get_url(self, url):
+    def get_url(self, entry):
         """
         Downloads files, which are set in the url section.
         If it's j2 template - parse it and save as .yml in template_directory
+        Raises exception if download, integrity check or rendering fails
         """
+        url, checks = catalog_entry(entry)
         # getting filename without jinja extension
         match_jinja = re.match(r"^.*\/(.*)\.j2$", url, re.IGNORECASE)
+        if match_jinja:
+            filename = match_jinja.group(1)
+        else:
+            filename = re.match(r"^.*\/(.*)", url).group(1)
+        file_path = os.path.join(self.template_directory, filename)
 
         try:
-            # downloading template
-            file_from_url = urlopen(urljoin(self.base_url, url)).read()
-            if match_jinja:
-                # if it's jinja template - replacing variables with dict
-                # dict should be generated with self.get_variable()
-                final_data = Environment(autoescape=True).from_string(file_from_url).render(self.vars)
-                filename = match_jinja.group(1)
-            else:
-                # If it's nont jinja - we just getting filename
-                final_data = file_from_url
-                filename = re.match(r"^.*\/(.*)", url).group(1)
-
-            # saving file
-            file_destination = open(os.path.join(self.template_directory, filename), 'w')
-            file_destination.write(final_data)
-            file_destination.close()
+            with self.tracer.span("get_url", url=url) as span:
+                # downloading template, unless it was already prefetched
+                file_from_url = self.prefetched.pop(url, None)
+                span.set(prefetched=file_from_url is not None)
+                if file_from_url is None:
+                    file_from_url = self.fetch(url)
+                entry = {
+                    'source': hashlib.sha256(file_from_url).hexdigest(),
+                    'vars': self.vars_hash() if match_jinja else None,
+                }
+                check_integrity(url, checks, len(file_from_url), entry['source'])
+                previous = self.previous_state.get('files', {}).get(url) or {}
+                if (previous.get('source') == entry['source'] and previous.get('vars') == entry['vars'] and
+                        previous.get('output') == file_hash(file_path)):
+                    # neither source nor variables were changed since the previous installation
+                    self.state['files'][url] = previous
+                    span.set(unchanged=True)
+                    return
+                if match_jinja:
+                    # if it's jinja template - replacing variables with dict
+                    # dict should be generated with self.get_variable()
+                    with self.tracer.span("render", url=url):
+                        with self.sources_lock:
+                            if self.jinja is None:
+                                self.jinja = self.jinja_environment()
+                            self.sources[url] = file_from_url.decode('utf-8')
+                            template = self.jinja.get_template(url)
+                        final_data = template.render(self.vars).encode('utf-8')
+                else:
+                    # If it's nont jinja - we just save it as is
+                    final_data = file_from_url
+
+                # saving file
+                file_destination = open(file_path, 'w')
+                file_destination.write(final_data)
+                file_destination.close()
+                span.set(bytes=len(final_data))
+                entry['output'] = hashlib.sha256(final_data).hexdigest()
+                self.state['files'][url] = entry
+                self.changed_files.add(filename)
         except:
-            try:
-                exit_code = self.dialog.msgbox(
-                    "Loading failed. Please try installation again", title="Failed!"
-                    )
+            # we don't want to leave half-written files in template_directory
+            if os.path.exists(file_path):
+                os.unlink(file_path)
+            raise
 
-                if exit_code == self.dialog.OK:
-                    self.main_window()
+    def get_bundle(self, entry):
+        """
+        Downloads bundle and extracts it to the template directory on the fly
+        Bundle should be a tar archive, packed with gzip, bz2 or xz
+        Raises exception if download, integrity check or extraction fails
+        """
+        bundle = catalog_entry(entry)[0]
+        with self.tracer.span("get_bundle", url=bundle) as span:
+            if self.prefetched_bundle is not None:
+                # bundle was already extracted by prefetch, we only need to move it
+                span.set(prefetched=True)
+                if self.prefetched_bundle_shared:
+                    self.bundle_store.link(self.prefetched_bundle, self.template_directory)
                 else:
-                    self.dialog_exit(manually=True)
-            except KeyboardInterrupt:
-                self.dialog_exit(manually=True)
+                    merge_tree(self.prefetched_bundle, self.template_directory)
+                    rmtree(self.prefetched_bundle, ignore_errors=True)
+                self.prefetched_bundle = None
+                self.state['bundle'] = self.prefetched_bundle_validators
+                self.changed_files.add(bundle)
+                return
+            response, validators = self.open_bundle(entry, self.template_directory)
+            if response is None:
+                # bundle wasn't changed since the previous installation
+                span.set(unchanged=True)
+                self.state['bundle'] = validators
+                return
+            stream = CountingStream(response) if self.tracer.enabled else response
+            try:
+                if self.bundle_store is None:
+                    extract_tar_stream(stream, self.template_directory)
+                else:
+                    # bundle is extracted once per host and linked to template directories
+                    path = self.bundle_store.lookup(validators)
+                    span.set(stored=path is not None)
+                    if path is None:
+                        path = self.bundle_store.add(stream, validators)
+                    self.bundle_store.link(path, self.template_directory)
             finally:
-                os.unlink(os.path.join(self.template_directory, filename))
+                response.close()
+                if stream is not response:
+                    span.set(bytes=stream.bytes)
+            self.state['bundle'] = validators
+            self.changed_files.add(bundle)
+
+    def fetch_all(self, urls, bundle=None):
+        """
+        Downloads all template files and bundle at once with self.fetch_workers threads.
+        Each file is rendered and saved as soon as its own download finishes.
+        Returns list of (url, error message) tuples for the failed files
+        """
+        self.previous_state = load_state(self.template_directory)
+        # vars contain passwords, so their hash is salted
+        self.state = {
+            'files': {},
+            'salt': self.previous_state.get('salt') or os.urandom(16).encode('hex'),
+        }
+        self.changed_files = set()
+        tasks = [(self.get_url, url) for url in urls]
+        if bundle:
+            tasks.append((self.get_bundle, bundle))
+        results = run_in_threads(lambda task: task[0](task[1]), tasks, self.fetch_workers)
+        return [
+            (catalog_entry(task[1])[0], str(error) or error.__class__.__name__)
+            for task, _, error in results if error is not None]
 
-    def get_bundle(self, bundle):
+    def show_fetch_failures(self, failures):
         """
-        Downloads bundle and extracts it to the template directory
-        Bundle should be an archive, packed with bz2 or gzip
+        Shows which files were not loaded and why.
+        Exits the script if user asked to stop it
         """
-        # selecting only filename from URL
-        bundle_file = re.match(r"^.*\/(.*)", bundle).group(1)
-        bundle_path = os.path.join(self.template_directory, bundle_file)
+        failed_list = "\n".join(
+            "  {0}: {1}".format(url, error) for url, error in failures)
         try:
-            # downloading bundle
-            urlretrieve(urljoin(self.base_url, bundle), bundle_path)
-            # checking bundle extension
-            if (
-                bundle_file.endswith("tar.gz") or bundle_file.endswith(".tgz") or
-                bundle_file.endswith("tar.bz2") or bundle_file.endswith(".tbz")
-            ):
-                # unpacking it to the template_directory
-                with tarfile.open(bundle_path, 'r:gz') as tar_archive:
-                    tar_archive.extractall(path=self.template_directory)
-        except:
-            try:
-                exit_code = self.dialog.msgbox(
-                    "Loading failed. Please try installation again",
-                    title="Failed!")
-                if exit_code == self.dialog.OK:
-                    self.category_window()
-                else:
-                    self.dialog_exit(manually=True)
-            except KeyboardInterrupt:
+            exit_code = self.dialog.msgbox(
+                "Loading failed for the following files:\n\n{0}\n\nPlease try installation again".format(
+                    failed_list),
+                title="Failed!",
+                width=70
+                )
+            if exit_code != self.dialog.OK:
                 self.dialog_exit(manually=True)
-        finally:
-            os.unlink(bundle_path)
+        except KeyboardInterrupt:
+            self.dialog_exit(manually=True)
+
+    def prepull_images(self, report=None):
+        """
+        Pulls images of the rendered docker-compose.yml before docker-compose up
+        Returns dict with the status of every image
+        """
+        compose_path = os.path.join(self.template_directory, "docker-compose.yml")
+        if not os.path.exists(compose_path):
+            return {}
+        # images, which failed to pull in background, are pulled again
+        pulled = set(image for image, status in self.prefetched_images.items() if status == "pulled")
+        with self.tracer.span("prepull_images") as span:
+            images = pull_images(compose_images(compose_path), self.pull_workers, report, pulled)
+            span.set(images=images)
+        return images
+
+    def show_pull_progress(self):
+        """
+        Pre-pulls images and shows status of every image in dialog mixedgauge
+        """
+        statuses = {}
+        lock = threading.Lock()
+
+        def report(image, status):
+            with lock:
+                statuses[image] = status.capitalize()
+                done = len([value for value in statuses.values() if value != "Pulling"])
+                self.dialog.mixedgauge(
+                    "Pulling docker images",
+                    title="Loading...",
+                    percent=int(100 * done / len(statuses)),
+                    elements=sorted(statuses.items()))
+
+        return self.prepull_images(report)
 
     def run_composer(self):
         """
-        Runs docker composer and dialog programbox for output
-        Returns dialog exit code
-        """
-        # Running composer
-        docker_compose = Popen(
-            ["docker-compose", "up", "-d"],
-            stdout=PIPE,
-            stderr=PIPE,
-            cwd=self.template_directory)
-        # Rendering stdout in programbox
-        code = self.dialog.progressbox(
-            fd=docker_compose.stderr.fileno(),
-            text="Installation progress")
-        return code
+        Runs docker composer and dialog progressbox for its progress
+        Returns docker-compose exit code
+        """
+        read_fd, write_fd = os.pipe()
+        # pipe fds are inherited by dialog otherwise: dialog with its own copy
+        # of write end never gets EOF and progressbox never returns
+        for fd in (read_fd, write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        result = []
+
+        def show(event):
+            if event['service'] and event['action']:
+                os.write(write_fd, "{0}: {1}\n".format(event['service'], event['action']))
+            else:
+                os.write(write_fd, event['line'] + "\n")
+
+        def compose():
+            try:
+                result.append(self.compose_up(on_event=show)[0])
+            except Exception as error:
+                os.write(write_fd, "Failed to run docker-compose: {0}\n".format(error))
+                result.append(-1)
+            finally:
+                # progressbox is closed as soon as pipe is closed
+                os.close(write_fd)
+
+        thread = threading.Thread(target=compose)
+        thread.daemon = True
+        thread.start()
+        try:
+            self.dialog.progressbox(fd=read_fd, text="Installation progress")
+        finally:
+            os.close(read_fd)
+        while thread.is_alive():
+            thread.join(0.1)
+        return result[0]
+
+    def log_event(self, event):
+        """
+        Writes docker-compose event to the event log, if it's enabled
+        """
+        if self.event_log is None:
+            return
+        record = dict(event, template=self.template, directory=self.template_directory)
+        with self.event_log_lock:
+            with open(self.event_log, 'a') as log_file:
+                log_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def wait_ready(self, started, report=None):
+        with self.tracer.span("wait_ready", template=self.template):
+            return self._wait_ready(started, report)
+
+    def _wait_ready(self, started, report=None):
+        """
+        Waits until containers of every service are running and healthy
+        and their published ports accept connections.
+        report(statuses) is called with dict of service statuses on every change.
+        Returns dict with status and seconds from started to ready for every service
+        """
+        if self.ready_timeout <= 0:
+            return self.readiness
+        compose_path = os.path.join(self.template_directory, "docker-compose.yml")
+        ports = compose_ports(compose_path) if os.path.exists(compose_path) else {}
+        prober = PortProber([port for service_ports in ports.values() for port in service_ports])
+        readiness = dict(
+            (service, {'status': "starting", 'ready_after': None}) for service in ports)
+        deadline = time.time() + self.ready_timeout
+        while True:
+            polled = time.time() + 1
+            states = container_states(self.template_directory)
+            ready_ports = prober.poll(timeout=1)
+            changed = False
+            for service in set(ports) | set(states):
+                entry = readiness.setdefault(service, {'status': "starting", 'ready_after': None})
+                if entry['status'] == "ready":
+                    continue
+                state, health = states.get(service, (None, None))
+                if state is None:
+                    status = "starting"
+                elif state != "running":
+                    status = state
+                elif health not in (None, "healthy"):
+                    status = health
+                elif not set(ports.get(service, [])) <= ready_ports:
+                    status = "waiting for ports"
+                else:
+                    status = "ready"
+                    entry['ready_after'] = round(time.time() - started, 3)
+                if status != entry['status']:
+                    entry['status'] = status
+                    changed = True
+            if changed and report is not None:
+                report(readiness)
+            if all(entry['status'] == "ready" for entry in readiness.values()):
+                break
+            if time.time() >= deadline:
+                break
+            # poll returns at once without ports to probe, while health checks are still starting
+            time.sleep(max(0, min(polled, deadline) - time.time()))
+        self.readiness = readiness
+        self.record_readiness(started)
+        return readiness
+
+    def record_readiness(self, started):
+        """
+        Appends time-to-ready of the template to the metrics file in cache directory
+        """
+        if self.cache is None:
+            return
+        ready_after = [entry['ready_after'] for entry in self.readiness.values()]
+        record = {
+            'template': self.template,
+            'started': started,
+            'services': self.readiness,
+            'ready_after': max(ready_after) if ready_after and None not in ready_after else None,
+        }
+        with self.cache.lock:
+            with open(os.path.join(self.cache.cache_directory, "readiness.jsonl"), 'a') as metrics:
+                metrics.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def show_readiness(self, started):
+        """
+        Waits for the containers and shows status of every service in dialog mixedgauge
+        """
+        def report(readiness):
+            elements = []
+            for service, entry in sorted(readiness.items()):
+                if entry['status'] == "ready":
+                    elements.append((service, "Ready in {0}s".format(entry['ready_after'])))
+                else:
+                    elements.append((service, entry['status'].capitalize()))
+            ready = len([entry for entry in readiness.values() if entry['status'] == "ready"])
+            self.dialog.mixedgauge(
+                "Waiting for application to start",
+                title="Starting...",
+                percent=int(100 * ready / max(len(readiness), 1)),
+                elements=elements)
+
+        return self.wait_ready(started, report)
 
     def show_value_error(self, errorid):
         """
@@ -240,6 +2604,10 @@ Please, contact support or try run script one more time with the command:
             stopflag = False
             messagetext = {1: "Please, input {0}".format(param),
                            2: "Please, input {0} one more time".format(param)}
+            # free host port is suggested for the port vars
+            init = {}
+            if len(asks) == 1 and param.upper().endswith("_PORT"):
+                init['init'] = str(self.vars.get(param) or self.ports.allocate()[0])
             while True:
                 if len(asks) > 1:
                     msgbox = "passwordbox"
@@ -249,7 +2617,8 @@ Please, contact support or try run script one more time with the command:
                     # Asking password twice and item once
                     exit_code, value[i] = getattr(self.dialog, msgbox)(
                         text=messagetext[i],
-                        insecure=True
+                        insecure=True,
+                        **init
                     )
                     if exit_code != self.dialog.OK:
                         if exit_code == self.dialog.CANCEL:
@@ -287,16 +2656,13 @@ Please, contact support or try run script one more time with the command:
             if self.stage == 0:
                 title = "Category selection"
                 dialogtext = "Please, select the matching category from the list:"
-                items = self.config.iteritems()
-                # TODO: set descriptionname the same in both functions
-                decitemname = 'description'
+                items = self.catalog.categories
             elif self.stage == 1:
                 title = "Template selection"
                 dialogtext = "Please, select the matching template from the list:"
-                items = self.config[self.category]['options'].iteritems()
-                decitemname = 'desc'
-            for key, val in items:
-                app_tuple.append((key, val[decitemname], val[decitemname]))
+                items = self.catalog.templates[self.category]
+            for key, description in items:
+                app_tuple.append((key, description, description))
             while True:
                 # display menu
                 exit_code, appcat = self.dialog.menu(
@@ -304,16 +2670,31 @@ Please, contact support or try run script one more time with the command:
                     choices=app_tuple,
                     title=title,
                     help_button=True,
-                    item_help=True
+                    item_help=True,
+                    extra_button=True,
+                    extra_label="Search"
                 )
+                if exit_code == self.dialog.EXTRA:
+                    if self.stage == 1: self.cancel_prefetch()
+                    if self.search_window() == self.dialog.OK:
+                        # template is selected, so main loop goes to the variables input
+                        self.stage = 1
+                        self.start_prefetch()
+                        exit_code = self.dialog.OK
+                        break
+                    continue
                 if exit_code == self.dialog.OK:
                     if self.stage == 0: self.category = appcat
-                    elif self.stage == 1: self.template = appcat
+                    elif self.stage == 1:
+                        self.template = appcat
+                        # downloading template, while user enters variables
+                        self.start_prefetch()
                     break
                 elif exit_code == self.dialog.HELP:
                     self.dialog_help()
                     continue
                 elif exit_code == self.dialog.CANCEL:
+                    if self.stage == 1: self.cancel_prefetch()
                     break
                 else:
                     self.dialog_exit(manually=True)
@@ -321,6 +2702,33 @@ Please, contact support or try run script one more time with the command:
         except (KeyboardInterrupt):
             self.dialog_exit(manually=True)
 
+    def search_window(self):
+        """
+        Window with template search over names and descriptions of all categories.
+        Sets category and template, if one of the found templates is selected
+        """
+        query = ""
+        while True:
+            exit_code, query = self.dialog.inputbox(
+                "Please, enter the name or words from the description of the template:",
+                init=query,
+                title="Template search",
+                width=60)
+            if exit_code != self.dialog.OK:
+                return exit_code
+            found = self.catalog.search(query)
+            if not found:
+                self.dialog.msgbox("Nothing is found for \"{0}\"".format(query), title="Template search", width=50)
+                continue
+            exit_code, name = self.dialog.menu(
+                text="Please, select the matching template from the list:",
+                choices=[("{0}/{1}".format(category, template), desc)
+                         for category, template, desc in found],
+                title="Found templates")
+            if exit_code == self.dialog.OK:
+                self.category, _, self.template = name.partition("/")
+                return exit_code
+
     def category_window(self):
         """
         Window with category selection
@@ -328,8 +2736,8 @@ Please, contact support or try run script one more time with the command:
         try:
             # generating list of the categories from the config
             category_tuple = []
-            for key, val in self.config.iteritems():
-                category_tuple.append((key, val['description'], val['description']))
+            for key, description in self.catalog.categories:
+                category_tuple.append((key, description, description))
             while True:
                 # display menu with category selection
                 exit_code, self.category = self.dialog.menu(
@@ -363,6 +2771,92 @@ Please, contact support or try run script one more time with the command:
         if all(exit_code): return "ok"
         else: return "cancel"
 
+    def start_prefetch(self):
+        """
+        Starts background download of the selected template.
+        Prefetch of the previously selected template is cancelled
+        """
+        if self.prefetch is not None:
+            if self.prefetch.template == self.template and not self.prefetch.cancelled.is_set():
+                return
+            self.cancel_prefetch()
+        self.prefetch = Prefetch(self, self.template).start()
+
+    def cancel_prefetch(self):
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+            self.prefetch = None
+
+    def take_prefetch(self):
+        """
+        Waits for prefetch of the selected template and takes its results
+        """
+        if self.prefetch is None or self.prefetch.template != self.template:
+            self.cancel_prefetch()
+            return
+        self.prefetch.wait()
+        self.prefetched = dict(self.prefetch.files)
+        self.prefetched_bundle = self.prefetch.bundle_directory
+        self.prefetched_bundle_validators = self.prefetch.bundle_validators
+        self.prefetched_bundle_shared = self.prefetch.bundle_shared
+        self.prefetched_images = dict(self.prefetch.images)
+        # staging directory now belongs to get_bundle
+        self.prefetch.bundle_directory = None
+        self.prefetch = None
+
+    def template_config(self):
+        """
+        Returns config section of the selected template
+        """
+        return self.config[self.category]['options'][self.template]
+
+    def template_dirs(self):
+        """
+        Returns list of directories from the dirs section, single directory may be set as string
+        """
+        dirs = self.template_config().get('dirs') or []
+        if isinstance(dirs, basestring):
+            return [dirs]
+        return list(dirs)
+
+    def preflight(self):
+        """
+        Checks rendered compose file of the template before any docker work starts.
+        Published host ports are claimed in self.ports, so concurrent stacks
+        don't publish the same port. Returns list of problems
+        """
+        compose_path = os.path.join(self.template_directory, "docker-compose.yml")
+        if not os.path.exists(compose_path):
+            return ["docker-compose.yml is not found in {0}".format(self.template_directory)]
+        with self.tracer.span("preflight", template=self.template):
+            problems = compose_problems(
+                compose_path, listening_ports(), self.previous_state.get('ports') or [])
+            if not problems:
+                ports = sorted(set(
+                    port for ports in compose_ports(compose_path).values() for port in ports))
+                taken = self.ports.claim(self.template_directory, ports)
+                problems = [
+                    "Host port {0} is published by the stack in {1}, which is being installed".format(
+                        port, owner)
+                    for port, owner in sorted(taken.items())]
+            if not problems:
+                # ports of this installation are listened by its own containers next time
+                self.state['ports'] = ports
+        return problems
+
+    def create_dirs(self):
+        """
+        Creates template directory and directories from the dirs section
+        """
+        with self.tracer.span("create_dirs"):
+            if not os.path.exists(self.template_directory):
+                os.makedirs(self.template_directory)
+            for folder in self.template_dirs():
+                try:
+                    os.makedirs(os.path.join(self.template_directory, folder))
+                except OSError:
+                    pass
+
     def postinstall(self):
         """
         Perform installation and download necessary files
@@ -373,30 +2867,353 @@ Please, contact support or try run script one more time with the command:
             os.makedirs(self.template_directory)
 
         self.dialog.infobox("Loading composer files", title="Loading...", height=5)
-        # checking, if we have urls, that needs to be downloaded
-        if "urls" in self.config[self.category]['options'][self.template]:
-            for url in self.config[self.category]['options'][self.template]['urls']:
-                self.get_url(url)
+        # most of the files are usually downloaded already, while user entered variables
+        self.take_prefetch()
+        # downloading urls and bundle of the template at once
+        with self.tracer.span("fetch_all", template=self.template):
+            failures = self.fetch_all(
+                self.template_config().get('urls', []),
+                bundle_entry(self.template_config()))
+        if failures:
+            # returning to the variables input, so user may try again
+            self.show_fetch_failures(failures)
+            return "cancel"
+        # port conflicts and broken compose file are reported before pulls and builds
+        problems = self.preflight()
+        if problems:
+            self.dialog.msgbox(
+                "Template can't be installed:\n\n{0}".format("\n".join(problems)),
+                title="Preflight failed",
+                width=70)
+            return "cancel"
 
-        # checking, if we have bundle, that needs to be downloaded
-        if "bundle" in self.config[self.category]['options'][self.template]:
-            self.get_bundle(self.config[self.category]['options'][self.template]['bundle'])
-
-        if "dirs" in self.config[self.category]['options'][self.template]:
-            for folder in self.config[self.category]['options'][self.template]['dirs']:
-                try:
-                    os.makedirs(os.path.join(self.template_directory, folder))
-                except OSError:
-                    pass
+        self.create_dirs()
+        self.apply_build_cache()
 
+        # pulling all images at once, so docker-compose only starts containers
+        self.images = self.show_pull_progress()
         # running docker composer
-        self.run_composer()
+        started = time.time()
+        with self.scheduled():
+            exit_code = self.run_composer()
+        if exit_code != 0:
+            self.ports.release(self.template_directory)
+            self.dialog.msgbox(
+                "docker-compose failed with exit code {0}. Please try installation again".format(exit_code),
+                title="Failed!",
+                width=50)
+            return "cancel"
+        self.show_readiness(started)
         try:
-            self.dialog_help(url=self.config[self.category]['options'][self.template]['help'])
+            self.dialog_help(url=self.template_config()['help'])
         finally:
             self.dialog_exit()
         pass
 
+    def for_stack(self, category, template, variables, directory=None):
+        """
+        Returns copy of this instance for installing one more template.
+        Copy shares config, cache and jinja environment with this instance
+        """
+        with self.sources_lock:
+            if self.jinja is None:
+                self.jinja = self.jinja_environment()
+        stack = copy.copy(self)
+        stack.category = category
+        stack.template = template
+        stack.vars = dict(variables or {})
+        stack.images = {}
+        stack.readiness = {}
+        stack.schedule = {'queue_wait': 0, 'run_time': 0}
+        stack.assigned_ports = {}
+        stack.prefetch = None
+        stack.prefetched = {}
+        stack.prefetched_bundle = None
+        stack.prefetched_bundle_validators = None
+        stack.prefetched_bundle_shared = False
+        stack.prefetched_images = {}
+        stack.previous_state = {}
+        stack.state = {'files': {}}
+        stack.changed_files = set()
+        stack.template_directory = os.path.expanduser(
+            directory or os.path.join(self.base_directory, template))
+        return stack
+
+    def build_services(self):
+        """
+        Returns parsed rendered compose file and list of (service, definition, context,
+        dockerfile, tag) for its services, which are built from Dockerfile.
+        Tag is named by hash of the Dockerfile and build context, so the same image
+        is never built twice
+        """
+        import yaml
+        compose_path = os.path.join(self.template_directory, "docker-compose.yml")
+        if not os.path.exists(compose_path):
+            return None, []
+        with open(compose_path) as compose_file:
+            compose = yaml.safe_load(compose_file) or {}
+        services = compose_services(compose)
+        # data directories and files, which are changed on every installation, are not a part of image
+        exclude = [folder.strip("/") for folder in self.template_dirs()] + ["docker-compose.yml", STATE_FILE]
+        result = []
+        for name, service in sorted((services or {}).items()):
+            if not isinstance(service, dict) or 'build' not in service:
+                continue
+            build = service['build']
+            context = build if isinstance(build, basestring) else build.get('context', ".")
+            dockerfile = "Dockerfile" if isinstance(build, basestring) else build.get(
+                'dockerfile', "Dockerfile")
+            context = os.path.normpath(os.path.join(self.template_directory, context))
+            digest = context_hash(context, dockerfile, build_args(build), exclude)
+            tag = "docker-dialog/{0}-{1}:{2}".format(
+                re.sub(r"[^a-z0-9_.-]", "", self.template.lower()),
+                re.sub(r"[^a-z0-9_.-]", "", name.lower()), digest[:16])
+            result.append((name, service, context, dockerfile, tag))
+        return compose, result
+
+    def apply_build_cache(self):
+        """
+        Rewrites rendered docker-compose.yml, so services built from Dockerfile use
+        cached image, when it's already present, instead of building it again.
+        Otherwise the image is built by docker-compose with the cache tag
+        """
+        import yaml
+        with self.tracer.span("build_cache", template=self.template) as span:
+            compose, services = self.build_services()
+            if not services:
+                return
+            cached = []
+            for name, service, _, _, tag in services:
+                service['image'] = tag
+                if image_exists(tag):
+                    del service['build']
+                    cached.append(name)
+            span.set(cached=cached)
+            compose_path = os.path.join(self.template_directory, "docker-compose.yml")
+            with open(compose_path, 'w') as compose_file:
+                yaml.safe_dump(compose, compose_file, default_flow_style=False)
+            # rewritten file is the output of its template, so it isn't rendered again next time
+            output = file_hash(compose_path)
+            for url, entry in self.state['files'].items():
+                if re.match(r"^(.*/)?docker-compose\.yml(\.j2)?$", url, re.IGNORECASE):
+                    entry['output'] = output
+
+    def prebuild(self):
+        """
+        Downloads the template to temporary directory and builds its images
+        with cache tags, so later installations don't build anything.
+        Returns dict with build status of every service
+        """
+        self.check_template()
+        self.template_directory = tempfile.mkdtemp(prefix="docker-dialog-prebuild-")
+        # variables don't get into images, so any values are good for rendering
+        self.vars = dict((variable, "prebuild") for variable in self.template_config().get('vars', []))
+        try:
+            failures = self.fetch_all(
+                self.template_config().get('urls', []), bundle_entry(self.template_config()))
+            if failures:
+                raise ProvisionError("Loading failed: {0}".format(
+                    "; ".join("{0}: {1}".format(url, error) for url, error in failures)))
+            self.create_dirs()
+            statuses = {}
+            for name, service, context, dockerfile, tag in self.build_services()[1]:
+                if image_exists(tag):
+                    statuses[name] = "present"
+                    continue
+                command = ["docker", "build", "-t", tag, "-f", os.path.join(context, dockerfile)]
+                for arg, value in sorted(build_args(service['build']).items()):
+                    command += ["--build-arg", "{0}={1}".format(arg, value)]
+                with self.tracer.span("docker_build", template=self.template, service=name):
+                    exit_code, _ = run_compose(command + [context], context)
+                statuses[name] = "built" if exit_code == 0 else "failed"
+            return statuses
+        finally:
+            rmtree(self.template_directory, ignore_errors=True)
+
+    def vars_hash(self):
+        return hashlib.sha256(
+            self.state.get('salt', "") + json.dumps(self.vars, sort_keys=True)).hexdigest()
+
+    def compose_command(self):
+        """
+        Returns docker-compose command, which applies changes of the rendered files,
+        or None if containers are already up to date.
+        Changed files other than docker-compose.yml (Dockerfile, configs, bundle)
+        may affect any service, so all of them are rebuilt and recreated then:
+        --build alone recreates only services with changed image or config, and
+        services with bind-mounted config would keep running with the old one
+        """
+        command = ["docker-compose", "up", "-d"]
+        compose_path = os.path.join(self.template_directory, "docker-compose.yml")
+        if not os.path.exists(compose_path):
+            return command
+        self.state['services'] = service_hashes(compose_path)
+        previous = self.previous_state.get('services')
+        if previous is None:
+            return command
+        removed = set(previous) - set(self.state['services'])
+        if removed:
+            command.append("--remove-orphans")
+        if self.changed_files - set(["docker-compose.yml"]):
+            return command + ["--build", "--force-recreate"]
+        changed = sorted(
+            service for service, digest in self.state['services'].items()
+            if previous.get(service) != digest)
+        if changed:
+            return command + ["--no-deps"] + changed
+        if removed:
+            return command
+        states = container_states(self.template_directory)
+        if set(states) == set(self.state['services']) and all(
+                state == "running" for state, _ in states.values()):
+            return None
+        return command
+
+    def save_state(self):
+        """
+        Saves hashes of the installed files and services to the template directory
+        """
+        with open(os.path.join(self.template_directory, STATE_FILE), 'w') as state_file:
+            json.dump(self.state, state_file, indent=2, sort_keys=True)
+
+    def compose_up(self, on_event=None):
+        """
+        Runs docker composer, writing its events to the event log
+        Returns composer exit code and its output
+        """
+        def handle(event):
+            self.log_event(event)
+            if on_event is not None:
+                on_event(event)
+
+        command = self.compose_command()
+        if command is None:
+            # nothing was changed since the previous installation
+            self.save_state()
+            return 0, ""
+        with self.tracer.span("compose_up", template=self.template, command=command) as span:
+            exit_code, lines = run_compose(command, self.template_directory, handle)
+            span.set(exit_code=exit_code)
+        if exit_code == 0:
+            self.save_state()
+        return exit_code, "\n".join(lines)
+
+    def provision(self):
+        """
+        Installs the template without user interaction: downloads and renders
+        files, creates directories and starts containers.
+        Raises ProvisionError if something fails
+        """
+        with self.tracer.span("provision", template=self.template):
+            try:
+                self._provision()
+            finally:
+                # containers listen on the claimed ports now, or they are not needed anymore
+                self.ports.release(self.template_directory)
+
+    def check_template(self):
+        """
+        Raises ProvisionError if selected template is not in the catalog
+        """
+        if self.category not in self.config:
+            raise ProvisionError("Unknown category {0}".format(self.category))
+        if self.template not in self.config[self.category]['options']:
+            raise ProvisionError("Unknown template {0} in category {1}".format(
+                self.template, self.category))
+
+    def _provision(self):
+        self.check_template()
+        missing = [
+            variable for variable in self.template_config().get('vars', [])
+            if variable not in self.vars]
+        # port vars, which were not given, get free host ports
+        port_vars = [variable for variable in missing if variable.upper().endswith("_PORT")]
+        for variable, port in zip(port_vars, self.ports.allocate(len(port_vars))):
+            self.vars[variable] = str(port)
+            self.assigned_ports[variable] = port
+        missing = [variable for variable in missing if variable not in self.vars]
+        if missing:
+            raise ProvisionError("Missing vars: {0}".format(", ".join(missing)))
+
+        if not os.path.exists(self.template_directory):
+            os.makedirs(self.template_directory)
+        with self.tracer.span("fetch_all", template=self.template):
+            failures = self.fetch_all(
+                self.template_config().get('urls', []),
+                bundle_entry(self.template_config()))
+        if failures:
+            raise ProvisionError("Loading failed: {0}".format(
+                "; ".join("{0}: {1}".format(url, error) for url, error in failures)))
+        problems = self.preflight()
+        if problems:
+            raise ProvisionError("Preflight failed: {0}".format("; ".join(problems)))
+        self.create_dirs()
+        self.apply_build_cache()
+
+        self.images = self.prepull_images()
+        # containers compete for the host resources mostly while they start
+        with self.scheduled():
+            started = time.time()
+            exit_code, output = self.compose_up()
+            if exit_code != 0:
+                raise ProvisionError("docker-compose exited with code {0}: {1}".format(
+                    exit_code, output.strip()[-500:]))
+            self.wait_ready(started)
+        if not all(entry['status'] == "ready" for entry in self.readiness.values()):
+            raise ProvisionError("Services are not ready in {0} seconds: {1}".format(
+                self.ready_timeout, ", ".join(sorted(
+                    service for service, entry in self.readiness.items()
+                    if entry['status'] != "ready"))))
+
+    def scheduled(self):
+        """
+        Returns context manager, which holds the scheduler slot for the template
+        and records queue wait and run time to self.schedule
+        """
+        return ScheduledRun(self)
+
+    def provision_stack(self, entry):
+        """
+        Installs one stack, described by dict with category, template, vars and directory keys.
+        Returns result dict, errors are reported there instead of being raised
+        """
+        try:
+            check_stack_entry(entry)
+        except ProvisionError as error:
+            return failed_result(entry, error)
+        stack = self.for_stack(
+            entry.get('category'), entry.get('template'),
+            entry.get('vars'), entry.get('directory'))
+        started = time.time()
+        try:
+            stack.provision()
+            status, error = "ok", None
+        except Exception as exc:
+            status, error = "failed", str(exc) or exc.__class__.__name__
+        return {
+            'category': stack.category,
+            'template': stack.template,
+            'directory': stack.template_directory,
+            'status': status,
+            'error': error,
+            'images': stack.images,
+            'readiness': stack.readiness,
+            'ports': stack.assigned_ports,
+            'queue_wait': round(stack.schedule['queue_wait'], 3),
+            'run_time': round(stack.schedule['run_time'], 3),
+            'duration': round(time.time() - started, 3),
+        }
+
+    def batch_provision(self, stacks, workers=4):
+        """
+        Installs all stacks from the manifest with at most workers stacks at once.
+        Every stack is a dict with category, template, vars and directory keys.
+        Returns list of result dicts, one for every stack
+        """
+        return [
+            result if error is None else failed_result(entry, error)
+            for entry, result, error in run_in_threads(self.provision_stack, stacks, workers)]
+
     def main_window(self):
         """
         Window with template selectionselection
@@ -404,8 +3221,8 @@ Please, contact support or try run script one more time with the command:
         try:
             # Generating a list of supported templates from the config
             template_tuple = []
-            for key, val in self.config[self.category]['options'].iteritems():
-                template_tuple.append((key, val['desc'], val['desc']))
+            for key, description in self.catalog.templates[self.category]:
+                template_tuple.append((key, description, description))
 
             while True:
                 # display matched templates from the self.category
@@ -432,9 +3249,328 @@ Please, contact support or try run script one more time with the command:
             self.dialog_exit(manually=True)
 
 
+class ProvisionDaemon(object):
+    """
+    Long-running provisioning service for the control panel.
+    Keeps catalog, compiled templates and HTTP connections of the headless
+    DockerDialog warm and installs jobs from the queue with at most workers
+    jobs at once. Jobs are submitted over the Unix socket with one JSON
+    object per line, every request gets one JSON line in response:
+        {"op": "submit", "category": ..., "template": ..., "vars": {...}, "directory": ...}
+            -> {"ok": true, "job": "1"}
+        {"op": "status", "job": "1"}  -> {"ok": true, "job": {... "status": "queued|running|ok|failed"}}
+        {"op": "jobs"}                -> {"ok": true, "jobs": [...]}
+        {"op": "catalog"}             -> {"ok": true, "catalog": {category: {template: {desc, vars}}}}
+        {"op": "reload"}              -> {"ok": true}, catalog is downloaded again if it was changed
+    """
+    # finished jobs, which are kept for status requests
+    keep_jobs = 1000
+
+    def __init__(self, ydialog, socket_path, workers=4):
+        self.ydialog = ydialog
+        self.socket_path = socket_path
+        self.workers = workers
+        self.queue = Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.server = None
+
+    def submit(self, request):
+        entry = dict(
+            (key, request.get(key)) for key in ('category', 'template', 'vars', 'directory'))
+        check_stack_entry(entry)
+        stack = self.ydialog.for_stack(
+            entry['category'], entry['template'], entry['vars'], entry['directory'])
+        # unknown templates are rejected right away instead of failing in the queue
+        stack.check_template()
+        with self.lock:
+            job_id = str(next(self.ids))
+            self.jobs[job_id] = {
+                'id': job_id,
+                'status': "queued",
+                'category': entry['category'],
+                'template': entry['template'],
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'result': None,
+            }
+        self.queue.put((job_id, entry))
+        return job_id
+
+    def worker(self):
+        while True:
+            job_id, entry = self.queue.get()
+            with self.lock:
+                self.jobs[job_id].update(status="running", started=time.time())
+            try:
+                result = self.ydialog.provision_stack(entry)
+            except Exception as error:
+                # job is never left running and the worker stays in the pool
+                result = failed_result(entry, error)
+            with self.lock:
+                self.jobs[job_id].update(status=result['status'], finished=time.time(), result=result)
+                self.forget_old_jobs()
+
+    def forget_old_jobs(self):
+        finished = sorted(
+            (job['finished'], job_id) for job_id, job in self.jobs.items() if job['finished'])
+        for _, job_id in finished[:max(0, len(finished) - self.keep_jobs)]:
+            del self.jobs[job_id]
+
+    def catalog(self):
+        return dict(
+            (category, dict(
+                (template, {'desc': options.get('desc'), 'vars': options.get('vars', [])})
+                for template, options in section['options'].items()))
+            for category, section in self.ydialog.config.items())
+
+    def handle(self, request):
+        """
+        Returns response for the API request
+        """
+        op = request.get('op')
+        if op == "submit":
+            return {'ok': True, 'job': self.submit(request)}
+        if op == "status":
+            with self.lock:
+                job = self.jobs.get(str(request.get('job')))
+                if job is None:
+                    return {'ok': False, 'error': "Unknown job {0}".format(request.get('job'))}
+                return {'ok': True, 'job': dict(job)}
+        if op == "jobs":
+            with self.lock:
+                return {'ok': True, 'jobs': sorted(
+                    (dict(job, result=None) for job in self.jobs.values()),
+                    key=lambda job: int(job['id']))}
+        if op == "catalog":
+            return {'ok': True, 'catalog': self.catalog()}
+        if op == "reload":
+            self.ydialog.load_catalog()
+            return {'ok': True}
+        return {'ok': False, 'error': "Unknown op {0}".format(op)}
+
+    def serve(self):
+        import SocketServer
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, ""):
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                        if not isinstance(request, dict):
+                            raise ValueError("request should be JSON object")
+                        response = daemon.handle(request)
+                    except Exception as error:
+                        response = {'ok': False, 'error': str(error) or error.__class__.__name__}
+                    self.wfile.write(json.dumps(response, sort_keys=True) + "\n")
+                    self.wfile.flush()
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = Server(self.socket_path, Handler)
+        # only the user, which runs the daemon, may submit jobs
+        os.chmod(self.socket_path, 0600)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def stop(self):
+        # shutdown waits for serve_forever, so it can't be called from the same thread
+        threading.Thread(target=self.server.shutdown).start()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Creates Docker containers from the templates of our docker repo")
+    parser.add_argument("--base-url", default="http://repo.vps.ua/docker/",
+                        help="URL of the docker repo with docker.yml")
+    parser.add_argument("--manifest",
+                        help="YAML/JSON file with stacks to install without dialog")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="how many stacks from the manifest or daemon jobs are installed at once")
+    parser.add_argument("--report",
+                        help="file for JSON report of the manifest installation (default: stdout)")
+    parser.add_argument("--pack", default=os.environ.get("DOCKER_DIALOG_PACK"),
+                        help="path or URL of the catalog pack, which replaces separate downloads")
+    parser.add_argument("--build-pack", metavar="OUTPUT",
+                        help="build catalog pack from the repo tree and exit")
+    parser.add_argument("--pack-root", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="repo tree for --build-pack (default: directory of this script)")
+    parser.add_argument("--prebuild", nargs="+", metavar="CATEGORY/TEMPLATE",
+                        help="build images of Dockerfile-based templates ahead of time ('all' for every template)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run provisioning daemon with JSON API on the Unix socket")
+    parser.add_argument("--socket", default=os.environ.get(
+                            "DOCKER_DIALOG_SOCKET", os.path.expanduser("~/.cache/docker-dialog/daemon.sock")),
+                        help="Unix socket of the daemon")
+    parser.add_argument("--trace", default=os.environ.get("DOCKER_DIALOG_TRACE"),
+                        help="file for Chrome trace of the provisioning stages")
+    parser.add_argument("--profile", default=os.environ.get("DOCKER_DIALOG_PROFILE"),
+                        help="file for cProfile stats of the main thread")
+    return parser.parse_args(argv)
+
+
+def dialog_options(args):
+    """
+    Returns DockerDialog keyword arguments, configured with environment variables
+    """
+    tracer = Tracer(enabled=bool(args.trace))
+    if args.trace:
+        # script usually ends with SystemExit, so trace is written at exit
+        atexit.register(tracer.write, args.trace)
+    session = HttpSession(
+        timeout=int(os.environ.get("DOCKER_DIALOG_HTTP_TIMEOUT", 15)),
+        retries=int(os.environ.get("DOCKER_DIALOG_HTTP_RETRIES", 3)),
+        tracer=tracer)
+    cache = UrlCache(
+        os.environ.get("DOCKER_DIALOG_CACHE_DIR", os.path.expanduser("~/.cache/docker-dialog")),
+        max_size=int(os.environ.get("DOCKER_DIALOG_CACHE_SIZE", 50)) * 1024 * 1024,
+        offline=os.environ.get("DOCKER_DIALOG_OFFLINE", "") not in ("", "0"),
+        ttl=int(os.environ.get("DOCKER_DIALOG_CACHE_TTL", 0)),
+        session=session)
+    atexit.register(cache.flush)
+    pack = None
+    if args.pack:
+        pack_path = args.pack
+        if re.match(r"^https?://", pack_path):
+            # pack is kept near the cache, so it's downloaded only when changed
+            pack_path = download_pack(
+                pack_path, os.path.join(cache.cache_directory, "catalog.pack"), session)
+        pack = CatalogPack(pack_path)
+    return {
+        'fetch_workers': int(os.environ.get("DOCKER_DIALOG_FETCH_WORKERS", 4)),
+        'cache': cache,
+        'session': session,
+        'pack': pack,
+        'bundle_store': BundleStore(
+            os.path.join(cache.cache_directory, "bundles"),
+            link_mode=os.environ.get("DOCKER_DIALOG_BUNDLE_LINK", "copy")),
+        'pull_workers': int(os.environ.get("DOCKER_DIALOG_PULL_WORKERS", 3)),
+        'ready_timeout': int(os.environ.get("DOCKER_DIALOG_READY_TIMEOUT", 300)),
+        'event_log': os.environ.get("DOCKER_DIALOG_EVENT_LOG"),
+        'tracer': tracer,
+        'scheduler': ResourceScheduler(
+            cores=float(os.environ.get("DOCKER_DIALOG_CORES", 0)),
+            memory=int(os.environ.get("DOCKER_DIALOG_MEMORY", 0))),
+    }
+
+
+def start_profiler(path):
+    """
+    Profiles the main thread with cProfile and dumps stats to path at exit
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    atexit.register(profiler.dump_stats, path)
+    atexit.register(profiler.disable)
+    profiler.enable()
+
+
+def batch_main(args):
+    """
+    Installs stacks from the manifest and writes JSON report.
+    Manifest is a list (or dict with stacks key) of entries like:
+        {category: Development, template: redmine, vars: {...}, directory: ~/redmine}
+    """
+    import yaml
+    with open(args.manifest) as manifest_file:
+        # JSON is a subset of YAML, so safe_load reads both of them
+        manifest = yaml.safe_load(manifest_file)
+    if isinstance(manifest, dict):
+        manifest = manifest.get('stacks', [])
+    if not isinstance(manifest, list):
+        raise SystemExit("Manifest {0} should be a list of stacks or a mapping with stacks list".format(
+            args.manifest))
+    try:
+        ydialog = DockerDialog(args.base_url, headless=True, **dialog_options(args))
+    except ProvisionError as error:
+        raise SystemExit(str(error))
+    results = ydialog.batch_provision(manifest, workers=args.workers)
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            report_file.write(report + "\n")
+    else:
+        print report
+    raise SystemExit(0 if all(result['status'] == "ok" for result in results) else 1)
+
+
+def prebuild_main(args):
+    """
+    Warms image build cache for the templates from the command line
+    """
+    try:
+        ydialog = DockerDialog(args.base_url, headless=True, **dialog_options(args))
+    except ProvisionError as error:
+        raise SystemExit(str(error))
+    templates = [
+        "{0}/{1}".format(category, template)
+        for category, section in sorted(ydialog.config.items())
+        for template in sorted(section['options'])]
+    if args.prebuild != ["all"]:
+        templates = args.prebuild
+    failed = False
+    for name in templates:
+        category, _, template = name.partition("/")
+        stack = ydialog.for_stack(category, template, {})
+        try:
+            statuses = stack.prebuild()
+        except ProvisionError as error:
+            print "{0}: failed ({1})".format(name, error)
+            failed = True
+            continue
+        for service, status in sorted(statuses.items()):
+            print "{0} {1}: {2}".format(name, service, status)
+            failed = failed or status == "failed"
+    raise SystemExit(1 if failed else 0)
+
+
+def daemon_main(args):
+    """
+    Runs provisioning daemon until SIGTERM or KeyboardInterrupt
+    """
+    try:
+        ydialog = DockerDialog(args.base_url, headless=True, **dialog_options(args))
+    except ProvisionError as error:
+        raise SystemExit(str(error))
+    try:
+        ProvisionDaemon(ydialog, args.socket, workers=args.workers).serve()
+    except KeyboardInterrupt:
+        pass
+    raise SystemExit(0)
+
+
 def main():
-    base_url = "http://repo.vps.ua/docker/"
-    ydialog = DockerDialog(base_url)
+    args = parse_args()
+    if args.build_pack:
+        names = build_pack(args.pack_root, args.build_pack)
+        print "{0}: {1} files".format(args.build_pack, len(names))
+        raise SystemExit(0)
+    if args.profile:
+        start_profiler(args.profile)
+    if args.manifest:
+        batch_main(args)
+    if args.prebuild:
+        prebuild_main(args)
+    if args.daemon:
+        daemon_main(args)
+    ydialog = DockerDialog(args.base_url, **dialog_options(args))
 #    if ydialog.category_window() == "ok":
 #        ydialog.stage += 1
     # ydialog.main_window()
@@ -447,7 +3583,7 @@ def main():
         # Variables input stage
         if ydialog.stage == 2: ret_code = ydialog.variables_input()
         # Installation stage (exits script)
-        if ydialog.stage == 3: ydialog.postinstall()
+        if ydialog.stage == 3: ret_code = ydialog.postinstall()
         # Perform stage change based on return code
         if ret_code == "ok": ydialog.stage += 1
         else: ydialog.stage -= 1